@@ -22,16 +22,14 @@
 Entry point for starting the application.
 
 Command line parsing happens here.
-It also decides if CLI or GUI is started.
+It also decides if CLI or GUI is started. Their modules are imported
+when started, so the help and console mode don't load Qt.
 """
 
 import sys
 import os
 import getopt
 
-from uicmd import consoleMenu
-from uiqt import qtMenu
-
 class Usage(Exception):
     def __init__(self, msg):
         self.msg = msg
@@ -46,6 +44,26 @@ def showUsage(argv):
     msg = "USAGE: " + cmdName(argv) + " <option>\n"
     msg += "    Where <option> is one of:\n"
     msg += "    -c      command line mode\n"
+    msg += "    --watch\n"
+    msg += "            prints the changes of devices and mounts as they\n"
+    msg += "            happen, in command line mode\n"
+    msg += "    --capture <file>\n"
+    msg += "            writes the system state read to a file and exits\n"
+    msg += "    --replay <file>\n"
+    msg += "            shows the system state of a capture file instead\n"
+    msg += "    --daemon\n"
+    msg += "            serves the system state to local clients\n"
+    msg += "    --remote\n"
+    msg += "            shows the system state served by the daemon\n"
+    msg += "    --metrics <file>\n"
+    msg += "            writes the metrics in Prometheus text format to a\n"
+    msg += "            file on exit and on SIGUSR1 (default: stderr)\n"
+    msg += "    --trace <file>\n"
+    msg += "            writes a timeline of the scans and commands as\n"
+    msg += "            Chrome trace events to a file on exit\n"
+    msg += "    --socket <path>\n"
+    msg += "            socket of the daemon, /run/dfmon/dfmon.socket by\n"
+    msg += "            default, in a directory writable by its owner only\n"
     msg += "    No option starts the GUI mode."
     return msg
 
@@ -54,7 +72,11 @@ def main(argv=None):
         argv = sys.argv
     try:
         try:
-            opts, dummy = getopt.getopt(argv[1:], "hc", ["help", "console"])
+            opts, dummy = getopt.getopt(argv[1:], "hc",
+                                        ["help", "console",
+                                         "capture=", "replay=", "daemon",
+                                         "remote", "socket=", "metrics=",
+                                         "trace=", "watch"])
         except getopt.error, msg:
             raise Usage(msg)
     except Usage, err:
@@ -65,9 +87,44 @@ def main(argv=None):
     if (unicode("-h"), "") in opts or (unicode("--help"), "") in opts:
         print >> sys.stdout, showUsage(argv)
         return 0
-    elif (unicode("-c"), "") in opts or (unicode("--console"), "") in opts:
+    from backend import enableMetricsDump
+    enableMetricsDump(dict(opts).get("--metrics"))
+    if "--trace" in dict(opts):
+        from backend import enableTracing
+        enableTracing(dict(opts)["--trace"])
+    if [opt for opt, arg in opts if opt in ("--capture", "--replay")]:
+        from backend import MyError
+        import capture
+        try:
+            for opt, arg in opts:
+                if opt == "--capture":
+                    capture.capture(arg)
+                    return 0
+                elif opt == "--replay":
+                    capture.replay(arg)
+        except MyError, e:
+            print >> sys.stderr, cmdName(argv)+":", str(e)
+            return 1
+    opts = dict(opts)
+    if "--daemon" in opts or "--remote" in opts:
+        import daemon
+        path = opts.get("--socket", daemon.DAEMON_SOCKET_PATH)
+        if "--daemon" in opts:
+            return daemon.runDaemon(path)
+        from backend import MyError, setStatus
+        try:
+            setStatus(daemon.RemoteStatus(path))
+        except MyError, e:
+            print >> sys.stderr, cmdName(argv)+":", str(e)
+            return 1
+    if "--watch" in opts:
+        from uicmd import watchStatus
+        return watchStatus()
+    if "-c" in opts or "--console" in opts:
+        from uicmd import consoleMenu
         return consoleMenu()
     else:
+        from uiqt import qtMenu
         return qtMenu(argv)
 
 # vim: set ts=4 sw=4 tw=0:
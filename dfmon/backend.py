@@ -31,12 +31,42 @@ import os
 import glob
 import stat
 import subprocess
+import tempfile
+import shutil
+import json
+import hashlib
+import signal
+import atexit
 import time
 import logging
-
-# required system paths
+import socket
+import errno
+import select
+import fcntl
+import re
+import struct
+import ctypes
+import ctypes.util
+import threading
+import functools
+from collections import namedtuple
+
+# required system paths, below ROOT_PATH (see setRoot())
+ROOT_PATH = "/"
 OS_DEV_PATH = "/dev/"
 OS_SYS_PATH = "/sys/class/scsi_device/"
+OS_MOUNTINFO_PATH = "/proc/self/mountinfo"
+OS_SWAPS_PATH = "/proc/swaps"
+OS_SYS_DEV_BLOCK_PATH = "/sys/dev/block/"
+OS_SYS_PATH_BASE = "/sys/" # uevent device paths are relative to it
+OS_UDEV_DATA_PATH = "/run/udev/data/"
+OS_PATH_NAMES = ["OS_DEV_PATH", "OS_SYS_PATH", "OS_MOUNTINFO_PATH",
+                 "OS_SWAPS_PATH", "OS_SYS_DEV_BLOCK_PATH", "OS_UDEV_DATA_PATH",
+                 "OS_SYS_PATH_BASE"]
+# numbers of the block device files below a redirected root by real path,
+# read from the file DEV_NODES_FILE there, None for the real root
+DEV_NODES = None
+DEV_NODES_FILE = "devnodes"
 
 # graphical sudo handlers to test for, last one is the fallback solution
 PLAIN_SUDO_QUESTION = "askforpwd"
@@ -44,6 +74,67 @@ KNOWN_SUDO_HANDLERS = [["kdesu", "-c"],
                      ["gksudo", "--"],
                      ["sudo", "-p", PLAIN_SUDO_QUESTION, "-s"],
                      ["su", "-c"]]
+# the working sudo handler found, see Status.sudoHandler()
+SUDO_CACHE_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                   os.path.join(os.path.expanduser("~"),
+                                                ".cache")),
+                               "dfmon", "sudohandler")
+
+# reading the output of system commands, see CommandPump
+PIPE_BUFFER_SIZE = 65536
+PUMP_MIN_DELAY = 1 # in milliseconds, checking for exited commands
+PUMP_MAX_DELAY = 50
+
+# the privileged helper process, see PrivilegedHelper
+HELPER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "helper.py")
+HELPER_START_TIMEOUT = 120 # in seconds, includes the password question
+
+# upper bounds of the latency histogram buckets in seconds, see Metrics
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+# spans kept at most while tracing, later ones are dropped, see Tracer
+TRACE_MAX_EVENTS = 1000000
+
+# number of devices removed at the same time, see removeDevices()
+REMOVAL_WORKERS = 4
+# number of block devices flushed at the same time, see BlockDevice.flush()
+FLUSH_WORKERS = 8
+# deadlines of the removal steps in seconds, see ScsiDevice.remove()
+REMOVAL_UMOUNT_TIMEOUT = 1.5
+REMOVAL_DELETE_TIMEOUT = 5.0
+# checking for the removal if the kernel notifications are not available
+REMOVAL_POLL_INTERVAL = 0.1
+
+# kernel uevent broadcast (netlink), the protocol number is not provided
+# by the socket module
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+UEVENT_BUFFER_SIZE = 16384
+# uevents which trigger a refresh of the device list
+UEVENT_SUBSYSTEMS = ["scsi", "block"]
+UEVENT_ACTIONS = ["add", "remove", "change"]
+
+# inotify(7) flags, see <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+INOTIFY_EVENT_HEADER = "iIII" # wd, mask, cookie, len
+INOTIFY_BUFFER_SIZE = 65536
+# directories in /dev/ watched for device file changes
+DEV_WATCH_DIRS = ["", "disk", "disk/by-*", "mapper"]
+DEV_WATCH_MASK = (IN_CREATE | IN_DELETE | IN_ATTRIB |
+                  IN_MOVED_FROM | IN_MOVED_TO)
+
+# ioctl flushing the buffers of a block device, see <linux/fs.h>
+BLKFLSBUF = 0x1261
 
 # were does this come from, how to determine this value ?
 BLOCKSIZE = long(512)
@@ -111,6 +202,87 @@ def getLineFromFile(filename):
     fd.close()
     return text
 
+def readProcFile(filename):
+    """
+    Returns the complete content of a (kernel status) file, read in one go.
+    """
+    try:
+        fd = open(filename, 'r')
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+    except IOError, e:
+        raise MyError("Failed to read '{0}': {1}".format(filename, str(e)))
+
+_LIBC = None
+
+def libc():
+    """Returns the C library for system calls not available in python."""
+    global _LIBC
+    if _LIBC is None:
+        _LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _LIBC
+
+def flushBlockDevice(devFile):
+    """
+    Flushes the buffers of a block device (BLKFLSBUF ioctl), requires
+    privileges. Raises EnvironmentError on failure.
+    """
+    fd = os.open(devFile, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKFLSBUF, 0)
+    finally:
+        os.close(fd)
+
+def syncFileSystem(path):
+    """
+    Writes the file system containing the path to disk (syncfs(2)).
+    Raises EnvironmentError on failure.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc().syncfs(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+    finally:
+        os.close(fd)
+
+def rootPath(path):
+    """Returns the given absolute system path below ROOT_PATH."""
+    return ROOT_PATH.rstrip(os.sep) + path
+
+def readDevNodes(filename):
+    """
+    Reads a table of block device files, one per line:
+    '<major>:<minor> <path below the root>'
+    Returns the device numbers by real path of the files.
+    """
+    devNodes = dict()
+    for line in readProcFile(filename).splitlines():
+        devId, sep, path = line.partition(" ")
+        major, sep, minor = devId.partition(":")
+        if not path or not major.isdigit() or not minor.isdigit():
+            continue
+        path = os.path.realpath(rootPath(path))
+        devNodes[path] = os.makedev(int(major), int(minor))
+    return devNodes
+
+def blockDeviceNumber(path):
+    """
+    Returns the number of the block device file at the given path,
+    symbolic links are followed. None for other files, raises OSError
+    if it does not exist.
+    """
+    if DEV_NODES is not None: # below a redirected root
+        if not os.path.exists(path):
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return DEV_NODES.get(os.path.realpath(path))
+    statinfo = os.stat(path)
+    if not stat.S_ISBLK(statinfo.st_mode):
+        return None
+    return statinfo.st_rdev
+
 class MyError(StandardError):
     def __init__(self, msg = ""):
         StandardError.__init__(self)
@@ -140,12 +312,264 @@ class DeviceHasPartitionsWarning(UserWarning):
 class RemovalSuccessInfo(Exception):
     pass
 
+class MultiRemovalInfo(Exception):
+    """Reports the results of removeDevices()."""
+    def __init__(self, results):
+        Exception.__init__(self)
+        self.results = results
+    def failed(self):
+        """Returns the (device, error) tuples of the failed removals."""
+        return [(dev, e) for dev, e in self.results if e is not None]
+    def __str__(self):
+        lines = []
+        for dev, e in self.results:
+            if e is None:
+                lines.append(dev.fullName()+": removed")
+            else:
+                lines.append(dev.fullName()+": "+str(e))
+        return "\n".join(lines)
+
+class Metrics(object):
+    """
+    Counters and latency histograms by name and labels, used by several
+    threads. Exported in the Prometheus text format, see dumpMetrics().
+    """
+    _lock = None
+    _counters = None # values by (name, labels)
+    _histograms = None # bucket counts, sum and count by (name, labels)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._histograms = dict()
+
+    def count(self, name, value = 1, **labels):
+        """Increases a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + value
+        finally:
+            self._lock.release()
+
+    def observe(self, name, seconds, **labels):
+        """Adds a duration to a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            if key not in self._histograms:
+                self._histograms[key] = [0] * len(METRICS_BUCKETS) + [0., 0]
+            histogram = self._histograms[key]
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+        finally:
+            self._lock.release()
+
+    def counter(self, name, **labels):
+        """Returns the value of a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        return self._counters.get(key, 0)
+
+    def prometheus(self):
+        """Returns all metrics in the Prometheus text format."""
+        self._lock.acquire()
+        try:
+            counters = sorted(self._counters.items())
+            histograms = [(key, list(values)) for key, values
+                          in sorted(self._histograms.items())]
+        finally:
+            self._lock.release()
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {0} counter".format(name))
+            lines.append(name+formatLabels(labels)+" "+repr(value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {0} histogram".format(name))
+            for bound, value in zip(METRICS_BUCKETS, histogram):
+                lines.append(name+"_bucket"+
+                             formatLabels(labels + (("le", repr(bound)), ))+
+                             " "+str(value))
+            lines.append(name+"_bucket"+
+                         formatLabels(labels + (("le", "+Inf"), ))+
+                         " "+str(histogram[-1]))
+            lines.append(name+"_sum"+formatLabels(labels)+
+                         " "+repr(histogram[-2]))
+            lines.append(name+"_count"+formatLabels(labels)+
+                         " "+str(histogram[-1]))
+        return "\n".join(lines)+"\n"
+
+def formatLabels(labels):
+    """Formats (name, value) tuples as Prometheus labels."""
+    if not labels:
+        return ""
+    escape = lambda value: (str(value).replace("\\", "\\\\")
+                            .replace("\"", "\\\"").replace("\n", "\\n"))
+    return "{"+",".join(["{0}=\"{1}\"".format(name, escape(value))
+                         for name, value in labels])+"}"
+
+def dumpMetrics(filename = None):
+    """
+    Writes the metrics in the Prometheus text format to the given file,
+    replacing it at once, or to stderr.
+    """
+    text = metrics().prometheus()
+    if filename is None:
+        sys.stderr.write(text)
+        return
+    try:
+        fd, tmpName = tempfile.mkstemp(dir = os.path.dirname(
+                                                os.path.abspath(filename)))
+        try:
+            os.write(fd, text)
+        finally:
+            os.close(fd)
+        os.chmod(tmpName, 0644)
+        os.rename(tmpName, filename)
+    except OSError, e:
+        logging.warning("Failed to write the metrics: "+str(e))
+
+def enableMetricsDump(filename = None):
+    """
+    Dumps the metrics on SIGUSR1 and, if written to a file, on exit.
+    Has to be called by the main thread. The signal handler only wakes up
+    a thread writing the dump, it may interrupt the main thread holding
+    the lock of the metrics.
+    """
+    readFd, writeFd = os.pipe()
+    for fd in readFd, writeFd:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    fcntl.fcntl(writeFd, fcntl.F_SETFL,
+                fcntl.fcntl(writeFd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    def dumpOnRequest():
+        while True:
+            try:
+                data = os.read(readFd, PIPE_BUFFER_SIZE)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if not data:
+                return
+            dumpMetrics(filename)
+    def requestDump(signum, frame):
+        try:
+            os.write(writeFd, "d")
+        except OSError:
+            pass # the pipe is full, dumps are pending already
+    thread = threading.Thread(target = dumpOnRequest, name = "metrics dump")
+    thread.daemon = True
+    thread.start()
+    signal.signal(signal.SIGUSR1, requestDump)
+    if filename is not None:
+        atexit.register(dumpMetrics, filename)
+
+class Tracer(object):
+    """
+    Records spans of time by thread, written as Chrome trace events
+    (JSON, for chrome://tracing or Perfetto), see enableTracing().
+    """
+    _lock = None
+    _events = None
+    _threads = None # names by thread id
+    _dropped = None # number of spans beyond TRACE_MAX_EVENTS
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = dict()
+        self._dropped = 0
+
+    def complete(self, name, start, end, args = None):
+        """Adds a span of the current thread, times in seconds."""
+        thread = threading.current_thread()
+        event = {"name": name, "ph": "X", "pid": os.getpid(),
+                 "tid": thread.ident, "ts": round(start * 1e6, 1),
+                 "dur": round((end - start) * 1e6, 1)}
+        if args:
+            event["args"] = args
+        self._lock.acquire()
+        try:
+            if thread.ident not in self._threads:
+                self._threads[thread.ident] = thread.name
+            if len(self._events) < TRACE_MAX_EVENTS:
+                self._events.append(event)
+            else:
+                self._dropped += 1
+        finally:
+            self._lock.release()
+
+    def write(self, filename):
+        """Writes the spans recorded so far, replacing the file at once."""
+        self._lock.acquire()
+        try:
+            events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                       "tid": tid, "args": {"name": name}}
+                      for tid, name in self._threads.items()]
+            events.extend(self._events)
+            dropped = self._dropped
+        finally:
+            self._lock.release()
+        text = json.dumps({"traceEvents": events, "displayTimeUnit": "ms",
+                           "otherData": {"dropped": dropped}})
+        try:
+            fd, tmpName = tempfile.mkstemp(dir = os.path.dirname(
+                                                    os.path.abspath(filename)))
+            try:
+                os.write(fd, text)
+            finally:
+                os.close(fd)
+            os.chmod(tmpName, 0644)
+            os.rename(tmpName, filename)
+        except OSError, e:
+            logging.warning("Failed to write the trace: "+str(e))
+
+def traced(name):
+    """
+    Decorator recording a span for every call while tracing is enabled,
+    with the string arguments (paths, device names) as details.
+    """
+    def decorator(fct):
+        @functools.wraps(fct)
+        def wrapper(*args, **kwargs):
+            if _TRACER is None:
+                return fct(*args, **kwargs)
+            start = time.time()
+            try:
+                return fct(*args, **kwargs)
+            finally:
+                details = [arg for arg in args if isinstance(arg, basestring)]
+                _TRACER.complete(name, start, time.time(),
+                                 details and {"args": details})
+        return wrapper
+    return decorator
+
+def enableTracing(filename):
+    """Records spans from now on, they are written to the file on exit."""
+    global _TRACER
+    if _TRACER is None:
+        _TRACER = Tracer()
+        atexit.register(_TRACER.write, filename)
+
 class SysCmd:
     _cmd = None # Popen object of the last command called
     _cmdList = None # command string list of the last command
     _cmdStatus = None # exit status of the recently invoked command
     _sudo = None
-    
+    _pipes = None # open output pipes (file objects) by file descriptor
+    _output = None # output read so far (list of strings) by file descriptor
+    _stdoutFd = None
+    _stderrFd = None
+    _name = None # of the command, without the sudo handler, for metrics
+    _started = None
+
     def __init__(self, cmdList, sudo = False):
         """
         Calls a system command in a subprocess asynchronously.
@@ -154,14 +578,19 @@ class SysCmd:
         self._sudo = False
         if not cmdList or len(cmdList) <= 0:
             raise MyError("No command supplied!")
+        if ROOT_PATH != os.sep:
+            raise MyError("System commands are disabled for a "
+                          "redirected root (replay)")
+        self._name = os.path.basename(cmdList[0].split(" ")[0])
         if sudo:
-            newcmd = STATUS.sudoHandler()[1:] # omit command name
+            newcmd = status().sudoHandler()[1:] # omit command name
             if "-c" in newcmd[-1]: # 'su -c' needs cmd as single string
                 newcmd.append(" ".join(cmdList))
             else:
                 newcmd.extend(cmdList)
             cmdList = newcmd
             self._sudo = True
+        self._started = time.time()
         try:
             #print "starting:", cmdList
             self._cmd = subprocess.Popen(cmdList,
@@ -169,11 +598,28 @@ class SysCmd:
                                stderr=subprocess.PIPE,
                                stdin=subprocess.PIPE)
         except Exception, e:
+            if self._sudo:
+                status().sudoFailed()
             raise MyError("Failed to run command: \n'"+
                                     " ".join(cmdList)+"': \n"+str(e))
         else:
+            metrics().count("dfmon_commands_total", command = self._name)
             self._cmdList = cmdList
             self._cmdStatus = self._cmd.poll()
+            self._pipes = dict()
+            self._output = dict()
+            # commands started later must not keep these pipes open
+            fcntl.fcntl(self._cmd.stdin.fileno(), fcntl.F_SETFD,
+                        fcntl.FD_CLOEXEC)
+            for pipe in self._cmd.stdout, self._cmd.stderr:
+                fd = pipe.fileno()
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+                self._pipes[fd] = pipe
+                self._output[fd] = []
+            self._stdoutFd = self._cmd.stdout.fileno()
+            self._stderrFd = self._cmd.stderr.fileno()
 
     def cmdFinished(self):
         if not self._cmd or self._cmd.poll() != None:
@@ -188,6 +634,50 @@ class SysCmd:
         else: # nothing changed
             return False
 
+    def pipes(self):
+        """Returns the file descriptors of the output pipes still open."""
+        if not self._pipes:
+            return []
+        return self._pipes.keys()
+
+    def read(self, fd):
+        """
+        Reads the output available on the given pipe without blocking.
+        Returns the data read, None at the end of the output.
+        """
+        try:
+            data = os.read(fd, PIPE_BUFFER_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return ""
+            data = "" # treat errors as end of output
+        if not data:
+            self._pipes.pop(fd).close()
+            return None
+        self._output[fd].append(data)
+        if fd == self._stderrFd:
+            self.answerSudoQuestion()
+        return data
+
+    def answerSudoQuestion(self):
+        """Sends the password, if sudo asks for it on stderr."""
+        if not self._sudo or status().sudoHandler()[0] != "sudo":
+            return
+        err = "".join(self._output[self._stderrFd])
+        if not err.endswith(PLAIN_SUDO_QUESTION):
+            return
+        # catch and handle sudo pwd question, not an error message
+        self._output[self._stderrFd] = [err[:-len(PLAIN_SUDO_QUESTION)]]
+        pwd = ""
+        if status().sudoPwdFct:
+            SUDO_PWD_LOCK.acquire() # one question at a time
+            try:
+                pwd = status().sudoPwdFct()
+            finally:
+                SUDO_PWD_LOCK.release()
+        self._cmd.stdin.write(pwd+"\n")
+        self._cmd.stdin.flush()
+
     def output(self):
         """Blocks until the last command finished.
         On success, returns a list of output lines.
@@ -195,34 +685,421 @@ class SysCmd:
         """
         if not self._cmd: 
             return []
-        stdout = []
-        stderr = []
-        while not self.cmdFinished():
-            if self._cmd.stderr:
-                err = self._cmd.stderr.read(len(PLAIN_SUDO_QUESTION)).strip()
-                if (self._sudo and
-                    STATUS.sudoHandler()[0] == "sudo" and
-                    err == PLAIN_SUDO_QUESTION):
-                    # catch and handle sudo pwd question
-                    if STATUS.sudoPwdFct:
-                        self._cmd.stdin.write(STATUS.sudoPwdFct()+"\n")
-                    else:
-                        self._cmd.stdin.write("\n")
-                else:
-                    err += self._cmd.stderr.readline()
-                stderr.append(err) # preserve possible error msgs
-            time.sleep(0.1) # wait some time for the command to finish
+        if not self.cmdFinished() or self.pipes():
+            pump = CommandPump()
+            pump.add(self)
+            pump.run()
+        if self._started is not None: # once per command
+            end = time.time()
+            metrics().observe("dfmon_command_seconds", end - self._started,
+                              command = self._name)
+            if _TRACER is not None:
+                _TRACER.complete("SysCmd", self._started, end,
+                                 {"command": " ".join(self._cmdList)})
+            self._started = None
         self.cmdStatusChanged()
         returncode = self._cmd.poll()
-        if self._cmd.stderr:
-            stderr.extend(self._cmd.stderr.readlines())
         if returncode != None and returncode != 0:
-            raise CmdReturnCodeError(self._cmdList,
-                                     returncode, "\n".join(stderr))
+            metrics().count("dfmon_command_failures_total",
+                            command = self._name)
+            if self._sudo:
+                status().sudoFailed()
+            raise CmdReturnCodeError(self._cmdList, returncode,
+                                     "".join(self._output[self._stderrFd]))
         # no error
-        if self._cmd.stdout:
-            stdout.extend(self._cmd.stdout.readlines())
-        return stdout
+        return "".join(self._output[self._stdoutFd]).splitlines(True)
+
+class CommandPump(object):
+    """
+    Reads the output of system commands (SysCmd) while they run, all
+    at once. Wakes up on output and end of output, the exit of a command
+    keeping its pipes open (e.g. by a daemon started) is polled for with
+    increasing delay.
+    """
+    _poller = None
+    _fds = None # SysCmd by file descriptor of its output pipes
+    _cmds = None # SysCmds running
+
+    def __init__(self):
+        self._poller = select.poll()
+        self._fds = dict()
+        self._cmds = []
+
+    def add(self, cmd):
+        self._cmds.append(cmd)
+        for fd in cmd.pipes():
+            self._poller.register(fd, select.POLLIN | select.POLLPRI)
+            self._fds[fd] = cmd
+
+    def remove(self, fd):
+        self._poller.unregister(fd)
+        del self._fds[fd]
+
+    def run(self):
+        """Returns when all the commands exited, their output is read."""
+        delay = PUMP_MIN_DELAY
+        while self._cmds:
+            try:
+                events = self._poller.poll(delay)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for fd, event in events:
+                if self._fds[fd].read(fd) is None:
+                    self.remove(fd)
+            for cmd in list(self._cmds):
+                if not cmd.cmdFinished():
+                    continue
+                for fd in cmd.pipes(): # read what is left, if any
+                    while cmd.read(fd):
+                        pass
+                    if fd in self._fds:
+                        self.remove(fd)
+                self._cmds.remove(cmd)
+            if events:
+                delay = PUMP_MIN_DELAY
+            else:
+                delay = min(delay*2, PUMP_MAX_DELAY)
+
+class PrivilegedHelper(object):
+    """
+    Client of the privileged helper process (see helper.py), started once
+    by the sudo handler. Operations requested by several threads run
+    concurrently.
+    """
+    _cmd = None # SysCmd of the sudo handler running the helper
+    _sock = None # connection to the helper
+    _reader = None # thread reading the responses
+    _running = None # False once the helper closed the connection
+    _cond = None # guards the requests, signals responses
+    _nextId = None
+    _responses = None # (error, output) by request id
+
+    def __init__(self, fake = False):
+        """
+        Starts the helper, it does nothing if fake (no privileges needed).
+        Raises MyError if that failed.
+        """
+        if not os.path.isfile(HELPER_PATH):
+            raise MyError("Privileged helper not found: "+HELPER_PATH)
+        self._cond = threading.Condition()
+        self._nextId = 0
+        self._responses = dict()
+        # accessible by the owner only (and root)
+        tmpDir = tempfile.mkdtemp(prefix = "dfmon-helper-")
+        sockPath = os.path.join(tmpDir, "socket")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            fcntl.fcntl(listener.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            listener.bind(sockPath)
+            listener.listen(1)
+            cmdList = [sys.executable, HELPER_PATH, sockPath]
+            if fake:
+                cmdList.insert(2, "--fake")
+            self._cmd = SysCmd(cmdList, sudo = not fake)
+            self._sock = self.accept(listener)
+        finally:
+            listener.close()
+            shutil.rmtree(tmpDir, True)
+        fcntl.fcntl(self._sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._running = True
+        self._reader = threading.Thread(target = self.readResponses)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def accept(self, listener):
+        """
+        Waits for the helper to connect, answers the sudo handler meanwhile.
+        Returns the connection.
+        """
+        poller = select.poll()
+        poller.register(listener.fileno(), select.POLLIN)
+        for fd in self._cmd.pipes():
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        deadline = time.time() + HELPER_START_TIMEOUT
+        while time.time() < deadline and not self._cmd.cmdFinished():
+            try:
+                events = poller.poll(PUMP_MAX_DELAY)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for fd, event in events:
+                if fd == listener.fileno():
+                    conn, dummy = listener.accept()
+                    return conn
+                if self._cmd.read(fd) is None:
+                    poller.unregister(fd)
+        if self._cmd.cmdFinished():
+            try:
+                self._cmd.output()
+            except CmdReturnCodeError, e:
+                raise MyError("Failed to start the privileged helper:\n"+
+                              str(e))
+            raise MyError("The privileged helper exited")
+        raise MyError("The privileged helper did not start within {0}s"
+                      .format(HELPER_START_TIMEOUT))
+
+    def readResponses(self):
+        reader = self._sock.makefile("r")
+        try:
+            for line in iter(reader.readline, ""):
+                try:
+                    reqId, error, output = json.loads(line)
+                except (ValueError, TypeError):
+                    continue
+                self._cond.acquire()
+                self._responses[reqId] = (error, output)
+                self._cond.notifyAll()
+                self._cond.release()
+        except socket.error, e:
+            logging.warning("Connection to the privileged helper failed: "+
+                            str(e))
+        self._cond.acquire()
+        self._running = False
+        self._cond.notifyAll()
+        self._cond.release()
+
+    def isRunning(self):
+        return self._running
+
+    def call(self, op, *args):
+        """
+        Runs an operation of the helper, returns its output.
+        Raises MyError if it failed.
+        """
+        self._cond.acquire()
+        try:
+            if not self._running:
+                raise MyError("The privileged helper exited")
+            reqId = self._nextId
+            self._nextId += 1
+            try:
+                self._sock.sendall(json.dumps([reqId, op] + list(args))+"\n")
+            except socket.error, e:
+                raise MyError("Failed to contact the privileged helper: "+
+                              str(e))
+            while reqId not in self._responses and self._running:
+                self._cond.wait()
+            if reqId not in self._responses:
+                raise MyError("The privileged helper exited")
+            error, output = self._responses.pop(reqId)
+        finally:
+            self._cond.release()
+        if error is not None:
+            raise MyError(error)
+        return output.encode("utf-8")
+
+    def close(self):
+        """Stops the helper, it exits when the connection is closed."""
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._reader.join()
+            self._sock.close()
+
+class Uevent(object):
+    """A single kernel uevent, see parseUevent()."""
+    _action = None
+    _devPath = None
+    _env = None # dictionary of the environment variables (KEY=value)
+
+    def __init__(self, action, devPath, env = None):
+        self._action = action
+        self._devPath = devPath
+        self._env = env
+        if not self._env:
+            self._env = dict()
+
+    def action(self):
+        return self._action
+
+    def devPath(self):
+        """Returns the path of the device relative to /sys."""
+        return self._devPath
+
+    def subsystem(self):
+        return self._env.get("SUBSYSTEM", "")
+
+    def env(self):
+        return self._env
+
+    def isRelevant(self):
+        """Tells if this event affects the list of devices shown."""
+        return (self.action() in UEVENT_ACTIONS and
+                self.subsystem() in UEVENT_SUBSYSTEMS)
+
+def parseUevent(data):
+    """
+    Parses the payload of a kernel uevent netlink message:
+    '<action>@<devpath>' followed by 'KEY=value' fields, separated by
+    null characters. Returns None for messages not sent by the kernel.
+    """
+    if not data:
+        return None
+    fields = data.split("\0")
+    if "@" not in fields[0]:
+        return None # e.g. messages with 'libudev' header
+    action, devPath = fields[0].split("@", 1)
+    env = dict()
+    for field in fields[1:]:
+        key, sep, value = field.partition("=")
+        if sep:
+            env[key] = value
+    return Uevent(env.get("ACTION", action), env.get("DEVPATH", devPath), env)
+
+class UeventMonitor(object):
+    """
+    Receives kernel uevents of the scsi and block subsystems.
+    Provides a file descriptor for select()/poll() or Qt socket notifiers.
+    """
+    _sock = None
+    _lost = None # True if the receive buffer overflowed
+
+    def __init__(self, sock = None):
+        """
+        Opens the uevent netlink socket or uses the given one
+        (any datagram socket delivering raw uevent payloads).
+        Raises MyError if the socket can't be opened.
+        """
+        self._lost = False
+        if sock is None:
+            try:
+                sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                     NETLINK_KOBJECT_UEVENT)
+                sock.bind((0, UEVENT_GROUP_KERNEL))
+            except (socket.error, AttributeError), e:
+                if sock is not None:
+                    sock.close()
+                raise MyError("Failed to open uevent socket: "+str(e))
+        sock.setblocking(False)
+        self._sock = sock
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def events(self):
+        """
+        Returns the relevant uevents received since the last call.
+        Does not block.
+        """
+        events = []
+        while self._sock is not None:
+            try:
+                data = self._sock.recv(UEVENT_BUFFER_SIZE)
+            except socket.error, e:
+                if e.errno == errno.ENOBUFS:
+                    # events were dropped by the kernel, state is unknown
+                    self._lost = True
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            event = parseUevent(data)
+            if event and event.isRelevant():
+                events.append(event)
+        return events
+
+    def lost(self):
+        """Tells if uevents were dropped since the last call."""
+        lost = self._lost
+        self._lost = False
+        return lost
+
+    def changed(self):
+        """Tells if any relevant uevent was received since the last call."""
+        changed = len(self.events()) > 0
+        return self.lost() or changed
+
+def ueventPaths(event):
+    """
+    Returns the sysfs paths a uevent concerns: the device and, for
+    holders like device-mapper devices, the devices they are built on.
+    """
+    path = os.path.join(OS_SYS_PATH_BASE, event.devPath().lstrip(os.sep))
+    paths = [path]
+    for slave in glob.glob(os.path.join(path, "slaves", "*")):
+        paths.append(os.path.realpath(slave))
+    return paths
+
+class Inotify(object):
+    """
+    Minimal inotify(7) binding. Provides a file descriptor for
+    select()/poll(), reading events does not block.
+    """
+    _fd = None
+    _watches = None # watched paths by watch descriptor
+
+    def __init__(self):
+        """Raises MyError if inotify is not available."""
+        try:
+            fd = libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError), e:
+            raise MyError("inotify not available: "+str(e))
+        if fd < 0:
+            raise MyError("inotify not available: "+
+                          os.strerror(ctypes.get_errno()))
+        self._fd = fd
+        self._watches = dict()
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def addWatch(self, path, mask):
+        """Watches the given path, returns False on failure."""
+        wd = libc().inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            return False
+        self._watches[wd] = path
+        return True
+
+    def watched(self):
+        """Returns the watched paths."""
+        return self._watches.values()
+
+    def events(self):
+        """
+        Returns the events since the last call as list of (path, mask)
+        tuples, path is the watched path joined with the entry name.
+        """
+        events = []
+        headerSize = struct.calcsize(INOTIFY_EVENT_HEADER)
+        while self._fd is not None:
+            try:
+                buf = os.read(self._fd, INOTIFY_BUFFER_SIZE)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            i = 0
+            while i + headerSize <= len(buf):
+                wd, mask, dummy, length = struct.unpack_from(
+                                    INOTIFY_EVENT_HEADER, buf, i)
+                i += headerSize
+                name = buf[i:i+length].rstrip("\0")
+                i += length
+                path = self._watches.get(wd, "")
+                if mask & IN_IGNORED:
+                    self._watches.pop(wd, None) # watch removed
+                if name:
+                    path = os.path.join(path, name)
+                events.append((path, mask))
+        return events
 
 class Status:
     """
@@ -232,20 +1109,55 @@ class Status:
     _mountStatus = None
     _swapStatus = None
     _devStatus = None # simple list of scsi device names available
+    _devMonitor = None # UeventMonitor, if available
+    _mountWatcher = None # ProcFileWatcher of the mount table, if available
+    _swapWatcher = None # ProcFileWatcher of the swap table, if available
     _devList = None # list of devices
+    _dirty = None # sysfs paths changed by uevents, None if unknown
+    _mountsChanged = None # True if mount or swap table changed since scan
+    _filesGeneration = None # of the device file cache at the last scan
     _sudo = None # sudo handler for the current system
+    _sudoCached = None # True if the sudo handler was not tested yet
     sudoPwdFct = None # The function to call when a sudo password is
                       # required. It has to return a string.
 
-    def __init__(self):
+    def __init__(self, monitor = True):
+        """
+        Checks the system, opens the kernel notifications for changes
+        unless monitor is False (for subclasses not scanning the system).
+        """
         if sys.platform != "linux2":
             raise MyError("This tool supports Linux only (yet).")
         for path in OS_DEV_PATH, OS_SYS_PATH:
             if not os.path.isdir(path):
                 raise MyError("Specified device path '{0}' does not exist !"
                               .format(path))
+        if not monitor or ROOT_PATH != os.sep:
+            return # the kernel notifications are about the real root
+        try:
+            self._devMonitor = UeventMonitor()
+        except MyError, e:
+            logging.info(str(e)+", polling for device changes")
+            self._devMonitor = None
+        try:
+            self._mountWatcher = ProcFileWatcher(OS_MOUNTINFO_PATH)
+        except MyError, e:
+            logging.info(str(e)+", comparing mount tables for changes")
+            self._mountWatcher = None
+        try:
+            self._swapWatcher = ProcFileWatcher(OS_SWAPS_PATH)
+        except MyError, e:
+            logging.info(str(e)+", comparing swap tables for changes")
+            self._swapWatcher = None
+
+    def isRemote(self):
+        """Tells if the devices are provided by a daemon (see daemon.py)."""
+        return False
 
     def sudoHandler(self):
+        if not self._sudo or len(self._sudo) == 0:
+            self._sudo = loadSudoHandler()
+            self._sudoCached = bool(self._sudo)
         if not self._sudo or len(self._sudo) == 0:
             self._sudo = None
             for handler in KNOWN_SUDO_HANDLERS:
@@ -258,13 +1170,26 @@ class Status:
                     self._sudo[:0] = [handler[0], handlerPath] # prepend
                     if self._sudoHandlerWorks():
                         break
-                if self._sudoHandlerWorks():
+                if self._sudo:
+                    saveSudoHandler(self._sudo)
                     break
         if not self._sudo or len(self._sudo) == 0:
             raise MyError("No sudo handler found: "+str(KNOWN_SUDO_HANDLERS))
         else:
             return self._sudo
 
+    def sudoFailed(self):
+        """
+        Called if a command run by the sudo handler failed to start or
+        returned an error. Tests a handler taken from the cache and forgets
+        it if it does not work (anymore), it is searched again on next use.
+        """
+        if not self._sudoCached:
+            return
+        self._sudoCached = False # tested once
+        if not self._sudoHandlerWorks():
+            forgetSudoHandler()
+
     def _sudoHandlerWorks(self):
         if self._sudo is None:
             return False
@@ -279,13 +1204,62 @@ class Status:
         else:
             return True
 
+    @traced("Status.update")
     def update(self):
+        start = time.time()
         self.devStatusChanged()
+        devices = time.time()
+        metrics().observe("dfmon_scan_seconds", devices - start,
+                          phase = "devices")
         self.mountStatusChanged()
-        self._swapStatus = SwapStatus()
-        self._devList = getScsiDevices(OS_SYS_PATH)
-
+        mounts = time.time()
+        metrics().observe("dfmon_scan_seconds", mounts - devices,
+                          phase = "mounts")
+        # rebuilds changed devices only
+        self._devList = getScsiDevices(OS_SYS_PATH, self._devList,
+                                       self.changedPaths())
+        self._filesGeneration = deviceFileCache().generation()
+        metrics().observe("dfmon_scan_seconds", time.time() - mounts,
+                          phase = "build")
+
+    def setDeviceMonitor(self, monitor):
+        """Replaces the UeventMonitor, e.g. by one fed by benchmark.py."""
+        self._devMonitor = monitor
+        self._dirty = None # compares all devices once
+
+    def changedPaths(self):
+        """
+        Returns the sysfs paths of the devices changed since the last scan,
+        as reported by uevents, and of the devices whose mount points or
+        device files changed. None if not known, without uevents.
+        Starts collecting them for the next scan.
+        """
+        dirty = self._dirty
+        if self._devMonitor is not None:
+            self._dirty = set()
+        mountsChanged = self._mountsChanged
+        self._mountsChanged = False
+        if dirty is None or self._devList is None:
+            return None
+        if (mountsChanged or
+            self._filesGeneration != deviceFileCache().generation()):
+            for dev in self._devList:
+                for blk in dev.blk().subtree().values():
+                    if blk.isStale():
+                        dirty.add(blk.sysfs())
+        return dirty
+
+    @traced("Status.devStatusChanged")
     def devStatusChanged(self):
+        if self._devMonitor is not None and self._devStatus is not None:
+            events = self._devMonitor.events()
+            lost = self._devMonitor.lost()
+            if lost:
+                self._dirty = None # compare all devices
+            elif self._dirty is not None:
+                for event in events:
+                    self._dirty.update(ueventPaths(event))
+            return len(events) > 0 or lost
         devStatus = [os.path.basename(p)
                      for p in glob.glob(OS_SYS_PATH+os.sep+"*")]
         if not self._devStatus or len(self._devStatus) != len(devStatus):
@@ -298,10 +1272,29 @@ class Status:
                 return True
         return False
 
+    @traced("Status.mountStatusChanged")
     def mountStatusChanged(self):
+        """Tells if the mount table or the active swap devices changed."""
+        swapChanged = self.swapStatusChanged()
+        if (self._mountWatcher is not None and self._mountStatus is not None
+            and not self._mountWatcher.changed()):
+            return swapChanged
         mountStatus = MountStatus()
         if not self._mountStatus or self._mountStatus != mountStatus:
             self._mountStatus = mountStatus
+            self._mountsChanged = True
+            return True
+        return swapChanged
+
+    def swapStatusChanged(self):
+        if (self._swapWatcher is not None and self._swapStatus is not None
+            and not self._swapWatcher.changed()):
+            return False
+        swapStatus = SwapStatus()
+        if (not self._swapStatus or
+            self._swapStatus.data() != swapStatus.data()):
+            self._swapStatus = swapStatus
+            self._mountsChanged = True
             return True
         return False
 
@@ -309,53 +1302,351 @@ class Status:
         self.update()
         return self._devList
 
+    def snapshot(self):
+        """Returns the state of the devices found as tuple of snapshots."""
+        devices = self.getDevices()
+        start = time.time()
+        snapshot = tuple([dev.snapshot() for dev in devices])
+        metrics().observe("dfmon_scan_seconds", time.time() - start,
+                          phase = "snapshot")
+        return snapshot
+
+    def getMountPoints(self, devNum, ioFiles):
+        """Returns the mount points of a block device, 'swap' for swap."""
+        if self.swap().isSwapDev(devNum):
+            return ["swap"]
+        return self.mount().getMountPoints(devNum, ioFiles)
+
     def swap(self):
+        if not self._swapStatus:
+            self.swapStatusChanged()
         return self._swapStatus
 
     def mount(self):
+        if not self._mountStatus:
+            self.mountStatusChanged()
         return self._mountStatus
 
+def sudoCacheKey(handlerPath):
+    """
+    Identifies the state a sudo handler was found working in: the
+    modification time of its binary, the search path and the graphical
+    session (graphical handlers fail without it, e.g. over ssh). None if
+    the binary does not exist.
+    """
+    try:
+        mtime = os.stat(handlerPath).st_mtime
+    except OSError:
+        return None
+    env = "\0".join([os.environ.get(name, "") for name
+                     in ("PATH", "DISPLAY", "WAYLAND_DISPLAY")])
+    return [mtime, hashlib.md5(env).hexdigest()]
+
+def loadSudoHandler():
+    """Returns the cached sudo handler, None if missing or stale."""
+    if not os.path.isfile(SUDO_CACHE_FILE):
+        return None
+    try:
+        handler, key = json.loads(readProcFile(SUDO_CACHE_FILE))
+        handler = [str(arg) for arg in handler]
+    except (MyError, ValueError, TypeError, UnicodeError):
+        return None
+    if (len(handler) < 2 or [handler[0]] + handler[2:]
+                            not in KNOWN_SUDO_HANDLERS or
+        key != sudoCacheKey(handler[1])):
+        return None
+    return handler
+
+def saveSudoHandler(handler):
+    """Stores the working sudo handler for the next runs."""
+    dirname = os.path.dirname(SUDO_CACHE_FILE)
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0700)
+        fd, tmpName = tempfile.mkstemp(dir = dirname)
+        try:
+            os.write(fd, json.dumps([handler, sudoCacheKey(handler[1])]))
+        finally:
+            os.close(fd)
+        os.rename(tmpName, SUDO_CACHE_FILE) # replaces it at once
+    except OSError, e:
+        logging.info("Failed to cache the sudo handler: "+str(e))
+
+def forgetSudoHandler():
+    """Removes the cached sudo handler, it is searched again next time."""
+    try:
+        os.remove(SUDO_CACHE_FILE)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            logging.info("Failed to remove the cached sudo handler: "+
+                         str(e))
+
 class SwapStatus:
     """
     Summary of active swap partitions or devices
     """
 
-    _swapData = None
-    _devices = None
+    _swapData = None # content of the swap table
+    _devices = None # set of device numbers of swap partitions
+
+    @traced("SwapStatus")
+    def __init__(self, path = None):
+        """Reads the swap table, /proc/swaps by default."""
+        if path is None:
+            path = OS_SWAPS_PATH
+        self._swapData = readProcFile(path)
+        self._devices = set()
+        # first line is the header
+        for line in self._swapData.splitlines()[1:]:
+            lineList = line.split()
+            if len(lineList) < 2 or lineList[1] != "partition":
+                continue
+            try:
+                devNum = blockDeviceNumber(
+                            rootPath(unescapeMountField(lineList[0])))
+            except OSError:
+                continue
+            if devNum is not None:
+                self._devices.add(devNum)
+
+    def data(self):
+        return self._swapData
+
+    def isSwapDev(self, devNum):
+        """Tells if the block device with the given number is used as swap."""
+        return devNum in self._devices
+
+# one line of the mount table, devId is '<major>:<minor>'
+MountRecord = namedtuple("MountRecord",
+                         "devId root mountPoint fsType source options")
+
+def unescapeMountField(text):
+    """Decodes octal escapes in mount table fields, e.g. '\\040' (space)"""
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), text)
+
+def parseMountInfoLine(line):
+    """
+    Parses a line of /proc/<pid>/mountinfo into a MountRecord:
+    <id> <parent> <major:minor> <root> <mountpoint> <options> [<optional>]
+    - <fstype> <source> <superoptions>
+    Returns None for malformed lines.
+    """
+    fields = line.split()
+    try:
+        sep = fields.index("-", 6)
+    except ValueError:
+        return None
+    if len(fields) < sep + 3:
+        return None
+    return MountRecord(fields[2], unescapeMountField(fields[3]),
+                       unescapeMountField(fields[4]), fields[sep+1],
+                       unescapeMountField(fields[sep+2]), fields[5])
+
+class ProcFileWatcher(object):
+    """
+    Signals changes of kernel tables in /proc which support poll(),
+    like mountinfo. POLLPRI is raised once per change for each open file,
+    hence every consumer needs its own watcher.
+    """
+    _fd = None
+    _poll = None
+
+    def __init__(self, path):
+        try:
+            self._fd = os.open(path, os.O_RDONLY)
+        except OSError, e:
+            raise MyError("Failed to watch '{0}': {1}".format(path, str(e)))
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLPRI | select.POLLERR)
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def changed(self, timeout = 0):
+        """
+        Tells if the file changed since the last call. Waits up to timeout
+        seconds for a change, forever if timeout is None.
+        """
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        try:
+            events = self._poll.poll(timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        return any([flags & select.POLLPRI for dummy, flags in events])
+
+class ChangeMonitor(object):
+    """
+    Kernel notifications of changed devices, mount and swap tables as
+    file descriptors for poll(), as far as available (see monitored()).
+    Changes of a redirected root (replay) have to be polled for.
+    """
+    _monitor = None # UeventMonitor, if available
+    _watchers = None # ProcFileWatchers by file descriptor
 
     def __init__(self):
-        """Returns the output of the 'swapon -s' command, line by line"""
-        cmd = SysCmd(["/sbin/swapon","-s"])
-        self._swapData = cmd.output()
-        # get a list of swap devices
-        self._devices = []
-        for line in self._swapData:
-            lineList = line.replace("\t"," ").split()
-            if lineList[1] != "partition":
+        self._watchers = dict()
+        if ROOT_PATH != os.sep:
+            return # the kernel notifications are about the real root
+        try:
+            self._monitor = UeventMonitor()
+        except MyError, e:
+            logging.info(str(e)+", polling for device changes")
+            self._monitor = None
+        for path in OS_MOUNTINFO_PATH, OS_SWAPS_PATH:
+            try:
+                watcher = ProcFileWatcher(path)
+            except MyError, e:
+                logging.info(str(e)+", polling for changes")
                 continue
-            self._devices.append(lineList[0])
+            self._watchers[watcher.fileno()] = watcher
 
-    def isSwapDev(self, ioFile):
-        if not self._devices or len(self._devices) < 1:
-            return False
-        resList = filter(strInList(ioFile), self._devices)
-        if resList and len(resList) > 0:
-            return True
+    def monitored(self):
+        """Tells if all changes are signaled, no polling needed."""
+        return self._monitor is not None and len(self._watchers) == 2
+
+    def events(self):
+        """Returns the poll() event masks by file descriptor."""
+        # POLLIN is always set for the kernel tables
+        events = dict([(fd, select.POLLPRI) for fd in self._watchers])
+        if self._monitor is not None:
+            events[self._monitor.fileno()] = select.POLLIN
+        return events
+
+    def handle(self, fd):
+        """
+        Reads the notification of a file descriptor polled, tells if it
+        signals a change.
+        """
+        if self._monitor is not None and fd == self._monitor.fileno():
+            return self._monitor.changed()
+        return fd in self._watchers
+
+    def close(self):
+        if self._monitor is not None:
+            self._monitor.close()
+        for watcher in self._watchers.values():
+            watcher.close()
+
+class RemovalWatcher(object):
+    """
+    Waits for the kernel to remove a device: for its remove uevent, its
+    sysfs directory disappearing (inotify) or, without both, by polling.
+    Has to be created before the removal is requested.
+    """
+    _sysfsPath = None # real path of the device in sysfs
+    _devPath = None # the same relative to /sys, as in uevents
+    _monitor = None # UeventMonitor, if available
+    _inotify = None # Inotify on the parent directory, if available
+    _removed = None
+
+    def __init__(self, sysfsPath):
+        self._sysfsPath = os.path.realpath(sysfsPath)
+        self._devPath = os.sep + os.path.relpath(self._sysfsPath,
+                                                 rootPath("/sys"))
+        self._removed = False
+        try:
+            self._monitor = UeventMonitor()
+        except MyError, e:
+            logging.info(str(e)+", watching sysfs for the removal")
+            self._monitor = None
         else:
-            return False
+            return
+        try:
+            self._inotify = Inotify()
+            self._inotify.addWatch(os.path.dirname(self._sysfsPath),
+                                   IN_DELETE | IN_DELETE_SELF)
+        except MyError, e:
+            logging.info(str(e)+", polling sysfs for the removal")
+            self._inotify = None
+
+    def close(self):
+        for source in self._monitor, self._inotify:
+            if source is not None:
+                source.close()
+
+    def removed(self):
+        """Tells if the device was removed, does not block."""
+        if self._monitor is not None:
+            for event in self._monitor.events():
+                if (event.action() == "remove" and
+                    event.devPath() == self._devPath):
+                    self._removed = True
+        elif self._inotify is not None:
+            self._inotify.events() # only the wake up is of interest
+        if not os.path.isdir(self._sysfsPath):
+            self._removed = True
+        return self._removed
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for the removal.
+        Returns True if the device was removed.
+        """
+        poller = select.poll()
+        for source in self._monitor, self._inotify:
+            if source is not None:
+                poller.register(source.fileno(), select.POLLIN)
+        deadline = time.time() + timeout
+        while not self.removed():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                # sysfs is checked regularly nevertheless, in case
+                # events are not delivered (e.g. in containers)
+                poller.poll(int(min(remaining, REMOVAL_POLL_INTERVAL)
+                                * 1000) + 1)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        return True
 
 class MountStatus:
     """Status of all the filesystems mounted in the system"""
 
-    _mountData = None
+    _mountData = None # content of the mount table
+    _records = None # list of MountRecords, in mount order
+    _byDevNum = None # dict of MountRecord lists by device number
+    _bySource = None # dict of MountRecord lists by canonical device path
+    _byMountPoint = None # dict of MountRecords by mount point
 
-    def __init__(self):
-        """Returns the output of the 'mount' command, line by line"""
-        cmd = SysCmd(["mount"])
-        self._mountData = cmd.output()
+    def __init__(self, path = None):
+        """
+        Reads and parses the mount table of this process in one go and
+        indexes it for lookups.
+        """
+        if path is None:
+            path = OS_MOUNTINFO_PATH
+        self._mountData = readProcFile(path)
+        self._records = []
+        self._byDevNum = dict()
+        self._bySource = dict()
+        self._byMountPoint = dict()
+        for line in self._mountData.splitlines():
+            record = parseMountInfoLine(line)
+            if record is None:
+                continue
+            self._records.append(record)
+            major, minor = record.devId.split(":")
+            devNum = os.makedev(int(major), int(minor))
+            self._byDevNum.setdefault(devNum, []).append(record)
+            source = rootPath(record.source)
+            if source.startswith(OS_DEV_PATH):
+                source = os.path.realpath(source)
+                self._bySource.setdefault(source, []).append(record)
+            # the last one mounted is visible
+            self._byMountPoint[record.mountPoint] = record
 
     def __eq__(self, other):
-        return "".join(self._mountData) == "".join(other.data())
+        return self._mountData == other.data()
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -363,20 +1654,43 @@ class MountStatus:
     def data(self):
         return self._mountData
 
-    def getMountPoint(self, ioFile):
-        if not self._mountData or len(self._mountData) < 1:
-            return ""
-        resList = filter(strInList(ioFile+" "), self._mountData)
-        mountPoint = ""
-        if resList and len(resList) > 0:
-            mountPoint = resList[0].split("on")[1]
-            mountPoint = mountPoint.split("type")[0]
-            mountPoint = removeLineBreak(mountPoint)
-        else:
-            global STATUS
-            if STATUS.swap().isSwapDev(ioFile):
-                mountPoint = "swap"
-        return mountPoint
+    def records(self, devNum = None):
+        """
+        Returns all MountRecords or those of the device with
+        the given number.
+        """
+        if devNum is None:
+            return self._records
+        return self._byDevNum.get(devNum, [])
+
+    def record(self, mountPoint):
+        """Returns the MountRecord visible at the given mount point."""
+        return self._byMountPoint.get(mountPoint, None)
+
+    def getMountPoints(self, devNum, ioFiles = None):
+        """
+        Returns all mount points of a block device, looked up by its
+        number and by its device files (for filesystems reporting
+        a different device number, like btrfs).
+        """
+        records = list(self._byDevNum.get(devNum, []))
+        if ioFiles:
+            for fn in ioFiles:
+                records.extend(self._bySource.get(os.path.realpath(fn), []))
+        mountPoints = []
+        for record in records:
+            if record.mountPoint not in mountPoints:
+                mountPoints.append(record.mountPoint)
+        return mountPoints
+
+# immutable state of a device tree, see BlockDevice.snapshot(),
+# partitions, holders and blk are snapshots again
+BlockSnapshot = namedtuple("BlockSnapshot",
+                           "sysfs devName devNum size ioFiles mountPoints "
+                           "inUse timeStamp partitions holders")
+ScsiSnapshot = namedtuple("ScsiSnapshot",
+                          "sysfs scsiStr driver vendor model "
+                          "timeStamp inUse blk")
 
 class Device:
     _sysfsPath = None # path to the device descriptor in /sys/
@@ -410,14 +1724,19 @@ class Device:
         return ""
 
 class BlockDevice(Device):
+    # identity, read on construction
     _devName = None
-    _ioFiles = None
     _devNum = None
+    # read on first access, None if not read yet
+    _ioFiles = None
     _size = None
     _partitions = None # list of BlockDevices
     _holders = None    # list of BlockDevices
-    _mountPoint = None
+    _mountPoints = None
     _timeStamp = None
+    _inUse = None # usage state of this device and its sub-devices
+    _reuse = None # BlockDevices to reuse for sub-devices, see __init__()
+    _snapshot = None # BlockSnapshot of the state read
 
     # getter methods
 
@@ -435,71 +1754,84 @@ class BlockDevice(Device):
         Returns the absolute filename of the block device file
         (usually in /dev/).
         """
-        if not self._ioFiles:
-            return []
+        if self._ioFiles is None:
+            self._ioFiles = deviceFileCache().getDeviceFiles(self._devNum)
         return self._ioFiles
 
     def mountPoint(self): 
         """
-        Returns the absolute path where this device is mounted.
+        Returns the absolute path where this device is mounted (first).
         Empty if unmounted.
         """
-        if not self._mountPoint:
+        if not self.mountPoints():
             return ""
-        return self._mountPoint
+        return self.mountPoints()[0]
+
+    def mountPoints(self):
+        """Returns all the paths where this device is mounted."""
+        if self._mountPoints is None:
+            self._mountPoints = status().getMountPoints(self._devNum,
+                                                        self.ioFiles())
+        return self._mountPoints
 
     def size(self): 
         """Returns the block devices size in bytes."""
+        if self._size is None:
+            self._size = getSize(self.sysfs())
         if not self._size:
             return -1
         return self._size
 
     def partitions(self): 
         """Returns the partitions as list of BlockDevices"""
-        if not self._partitions:
-            return []
+        if self._partitions is None:
+            self._partitions = self.getSubDevices(self.sysfs(),
+                                                  self._devName+"*")
+            self.subDevicesRead()
         return self._partitions
 
     def holders(self): 
         """Returns the holders as list of BlockDevices"""
-        if not self._holders:
-            return []
+        if self._holders is None:
+            basePath = self.sysfs()+"holders"+os.sep
+            self._holders = self.getSubDevices(basePath, "*")
+            self.subDevicesRead()
         return self._holders
 
+    def subDevicesRead(self):
+        if self._partitions is not None and self._holders is not None:
+            self._reuse = None # don't keep previous devices longer
+
     def isBlock(self):
         return True
 
-    def __init__(self, sysfsPath, blkDevName):
+    @traced("BlockDevice")
+    def __init__(self, sysfsPath, blkDevName, reuse = None):
+        """
+        Identifies the block device at the given sysfs path by its number.
+        Everything else, including the sub-devices, is read on first access.
+        Unchanged sub-devices found in the reuse dictionary (by sysfs path)
+        are kept instead of reading them again.
+        """
         Device.__init__(self, sysfsPath)
         self.setSysfs(self.sysfs() + os.sep)
         self._devName = blkDevName
-        self._size = getSize(sysfsPath)
-        if self._size < 0:
-            raise MyError("Could not determine block device size")
         self.getDeviceNumber()
-        self._ioFiles = DEVICE_FILE_CACHE.getDeviceFiles(self._devNum)
-        for fn in self._ioFiles:
-            if not os.path.exists(fn):
-                raise MyError("Could not find IO device path '{0}'".format(fn))
-        self.timeStamp()
-        self.update()
+        self.update(reuse)
         # final verification
         if not self.isValid():
             raise MyError("Determined block device information not valid")
 
-    def update(self):
-        # determine mount point
-        self._mountPoint = None
-        for fn in self._ioFiles:
-            self._mountPoint = STATUS.mount().getMountPoint(fn)
-            if (self._mountPoint == "swap" or
-                os.path.isdir(self._mountPoint)):
-                break
-        # get partitions eventually
-        self._partitions = self.getSubDevices(self.sysfs(), self._devName+"*")
-        # get holders eventually
-        basePath = self.sysfs()+"holders"+os.sep
-        self._holders = self.getSubDevices(basePath, "*")
+    def update(self, reuse = None):
+        """Drops the state read so far, it is read again on access."""
+        self._ioFiles = None
+        self._size = None
+        self._mountPoints = None
+        self._partitions = None
+        self._holders = None
+        self._inUse = None
+        self._reuse = reuse
+        self._snapshot = None
 
     def getSubDevices(self, basePath, matchStr):
         """
@@ -507,52 +1839,97 @@ class BlockDevice(Device):
         """
         if not self.isValid():
             return []
-        entries = glob.glob(basePath + matchStr)
-        if entries is None or len(entries) <= 0:
-            return []
-        # return a list of the holder names relative to the input block path
-        relativeNames = [path[len(basePath):] for path in entries]
         # add all partitions as block devices (recursive)
         deviceList = []
-        for devName in relativeNames:
-            queryPath = os.path.join(basePath, devName)
-            if not os.path.isdir(queryPath):
-                continue
-            blockDev = BlockDevice(queryPath, devName)
+        for queryPath, devName in getSubDevicePaths(basePath, matchStr):
+            blockDev = None
+            if self._reuse:
+                blockDev = self._reuse.get(os.path.realpath(queryPath)+os.sep)
+            if (blockDev is None or blockDev.fingerprint() !=
+                                   blockFingerprint(queryPath, devName)):
+                blockDev = BlockDevice(queryPath, devName, self._reuse)
             if not blockDev.isValid():
                 raise MyError("Not Valid")
             deviceList.append(blockDev)
         return deviceList
 
-    def inUse(self):
-        if self._holders and len(self._holders) > 0:
-            for h in self._holders:
-                if h.inUse():
-                    return True
-        if self._partitions and len(self._partitions) > 0:
-            for p in self._partitions:
-                if p.inUse():
-                    return True
-        if self._mountPoint:
+    def fingerprint(self):
+        """
+        Identifies the state of this device and its sub-devices: sysfs path,
+        device number, size, device files, mount points and the sub-devices.
+        Equals blockFingerprint() of the sysfs path as long as nothing
+        changed.
+        """
+        children = [dev.fingerprint()
+                    for dev in self.partitions() + self.holders()]
+        return (self.sysfs(), self._devNum, self.size(),
+                tuple(self.ioFiles()), tuple(self.mountPoints()),
+                tuple(children))
+
+    def isStale(self):
+        """
+        Tells if the device files or mount points read differ from the
+        current ones, without reading sysfs.
+        """
+        if (self._ioFiles is not None and
+            self._ioFiles != deviceFileCache().getDeviceFiles(self._devNum)):
             return True
-        return False
+        return (self._mountPoints is not None and self._mountPoints !=
+                status().getMountPoints(self._devNum, self.ioFiles()))
+
+    def snapshot(self):
+        """
+        Returns the state of this device and its sub-devices as
+        BlockSnapshot, reads everything not read yet. Reused devices
+        return the same snapshot object as before.
+        """
+        if self._snapshot is None:
+            self._snapshot = BlockSnapshot(self.sysfs(), self._devName,
+                    self._devNum, self.size(), tuple(self.ioFiles()),
+                    tuple(self.mountPoints()), self.inUse(), self.timeStamp(),
+                    tuple([dev.snapshot() for dev in self.partitions()]),
+                    tuple([dev.snapshot() for dev in self.holders()]))
+        return self._snapshot
+
+    def subtree(self):
+        """Returns this device and all sub-devices by sysfs path."""
+        devices = dict()
+        devices[self.sysfs()] = self
+        for dev in self.partitions() + self.holders():
+            devices.update(dev.subtree())
+        return devices
+
+    def inUse(self):
+        """
+        Tells if this device or one of its sub-devices is mounted.
+        Determined once bottom-up, update() refreshes it.
+        """
+        if self._inUse is None:
+            self._inUse = False
+            if self.mountPoints():
+                self._inUse = True
+            elif any([h.inUse() for h in self.holders()]):
+                self._inUse = True
+            elif any([p.inUse() for p in self.partitions()]):
+                self._inUse = True
+        return self._inUse
 
     def __str__(self):
         res = ""
-        for attr in [self._devName, self._ioFiles, self._mountPoint, 
-                     formatSize(self._size), self._devNum, self.sysfs()]:
+        for attr in [self._devName, self.ioFiles(), self.mountPoints(),
+                     formatSize(self.size()), self._devNum, self.sysfs()]:
             res = res + str(attr) + " "
 
         global OUTPUT_INDENT
         OUTPUT_INDENT = OUTPUT_INDENT + "  "
         prefix = "\n" + OUTPUT_INDENT
-        if self._holders:
+        if self.holders():
             res = res + prefix + "[holders:]"
-            for h in self._holders:
+            for h in self.holders():
                 res = res + prefix + str(h)
-        elif self._partitions:
+        elif self.partitions():
             res = res + prefix + "[partitions:]"
-            for p in self._partitions:
+            for p in self.partitions():
                 res = res + prefix + str(p)
         else:
             pass
@@ -564,9 +1941,7 @@ class BlockDevice(Device):
     def isValid(self):
         return self._devName and \
                 os.path.isdir(self.sysfs()) and \
-                all([os.path.exists(fn) for fn in self._ioFiles]) and \
-                self._devNum > 0 and \
-                self._size >= 0
+                self._devNum > 0
 
     def timeStamp(self):
         """Get the time this device was added to the system."""
@@ -592,19 +1967,17 @@ class BlockDevice(Device):
 
     def getDeviceNumber(self):
         if not self._devNum:
-            fn = os.path.join(self.sysfs(), "dev")
-            if not os.path.isfile(fn):
-                return -1
-            (major, minor) = getLineFromFile(fn).split(":")
-            if not major or not minor or major < 0 or minor < 0:
+            devNum = getDevNum(self.sysfs())
+            if devNum < 0:
                 return -1
-            self._devNum = os.makedev(int(major), int(minor))
+            self._devNum = devNum
         return self._devNum
 
     def mount(self, password = None):
         """Mount block device"""
+        self._inUse = None
         # no partitions
-        if len(self._partitions) == 0:
+        if len(self.partitions()) == 0:
             if not any([os.path.exists(fn) for fn in self.ioFiles()]):
                 return
             if self.inUse():
@@ -612,66 +1985,143 @@ class BlockDevice(Device):
             else:
                 try:
                     if password is not None:
-                        cmd = SysCmd(["truecrypt", "-t",
-                                      "--non-interactive",
-                                      "-p", password,
-                                      "--mount", self.ioFiles()[0]],
-                                     sudo = True)
+                        privileged("truecrypt", "-t", "--non-interactive",
+                                   "-p", password,
+                                   "--mount", self.ioFiles()[0])
                     else:
-                        cmd = SysCmd(["truecrypt", "--mount",
-                                      self.ioFiles()[0]], sudo = True)
-                    cmd.output()
+                        privileged("truecrypt", "--mount", self.ioFiles()[0])
                 except MyError, e:
                     raise MyError("Failed to mount '{0}':\n{1}"
                                   .format(self.ioFiles()[0], str(e)))
-        elif len(self._partitions) == 1:
-            self._partitions[0].mount()
+        elif len(self.partitions()) == 1:
+            self.partitions()[0].mount()
         else:
             raise DeviceHasPartitionsWarning()
         self.update()
 
     def umount(self):
         """Unmount block device"""
-        for part in self._partitions:
+        self._inUse = None
+        for part in self.partitions():
             part.umount()
-        for holder in self._holders:
+        for holder in self.holders():
             holder.umount()
-        if not os.path.isdir(self.mountPoint()):
-            return
         # function tests for truecrypt device files
         isTruecrypt = strInList("truecrypt")
-        try:
-            cmd = None
-            if any([isTruecrypt(fn) for fn in self._ioFiles]):
-                # --non-interactive
-                cmd = SysCmd(["truecrypt", "-t",
-                              "--non-interactive",
-                              "-d", self.mountPoint()], True)
-            else:
-                cmd = SysCmd(["umount", self.mountPoint()], True)
-            stdout = "".join(cmd.output())
-            if len(stdout) > 0 and stdout != "passprompt":
-                raise MyError(stdout)
-        except MyError, e:
-            raise MyError("Failed to umount '{0}':\n{1}"
-                          .format(self.ioFiles()[0], str(e)))
+        # latest mounts first, they may cover previous ones
+        for mountPoint in reversed(self.mountPoints()):
+            if not os.path.isdir(mountPoint):
+                continue
+            try:
+                if any([isTruecrypt(fn) for fn in self.ioFiles()]):
+                    # --non-interactive
+                    stdout = privileged("truecrypt", "-t",
+                                        "--non-interactive", "-d", mountPoint)
+                else:
+                    stdout = privileged("umount", mountPoint)
+                if len(stdout) > 0 and stdout != "passprompt":
+                    raise MyError(stdout)
+            except MyError, e:
+                raise MyError("Failed to umount '{0}':\n{1}"
+                              .format(self.ioFiles()[0], str(e)))
         self.update()
 
     def flush(self):
-        """Flushes the device buffers."""
-        for part in self._partitions:
-            part.flush()
-        for holder in self._holders:
-            holder.flush()
-        if self.inUse() or not os.path.exists(self.ioFiles()[0]):
+        """
+        Flushes the buffers of this device and its sub-devices. The deepest
+        sub-devices are flushed first, the ones on the same level at once.
+        """
+        for level in reversed(self.levels()):
+            for dev, e in runConcurrently(BlockDevice.flushBuffers, level,
+                                          FLUSH_WORKERS):
+                if e is not None:
+                    # what to do on fail, ignore ?
+                    raise e
+
+    def levels(self):
+        """Returns this device and its sub-devices as lists by depth."""
+        levels = [[self]]
+        seen = set([self._devNum])
+        while True:
+            level = []
+            for dev in levels[-1]:
+                for sub in dev.partitions() + dev.holders():
+                    if sub.getDeviceNumber() not in seen:
+                        seen.add(sub.getDeviceNumber())
+                        level.append(sub)
+            if not level:
+                return levels
+            levels.append(level)
+
+    def flushBuffers(self):
+        """
+        Flushes the buffers of this device only, by ioctl or by the
+        privileged helper if not permitted. File systems still mounted are
+        written to disk instead.
+        """
+        if not self.ioFiles() or not os.path.exists(self.ioFiles()[0]):
             return
         try:
-            cmd = SysCmd(["/sbin/blockdev",
-                          "--flushbufs", self.ioFiles()[0]], True)
-            cmd.output()
-        except CmdReturnCodeError, e:
-            # what to do on fail, ignore ?
-            raise MyError(str(e))
+            if self.inUse():
+                for mountPoint in self.mountPoints():
+                    if os.path.isdir(mountPoint):
+                        syncFileSystem(mountPoint)
+            else:
+                flushBlockDevice(self.ioFiles()[0])
+        except EnvironmentError, e:
+            if self.inUse() or e.errno not in (errno.EPERM, errno.EACCES):
+                raise MyError("Failed to flush '{0}': {1}"
+                              .format(self.ioFiles()[0], str(e)))
+            privileged("flush", self.ioFiles()[0])
+
+def getDevNum(sysfsPath):
+    """
+    Returns the number of the block device at the given sysfs path,
+    -1 if not available.
+    """
+    text = getLineFromFile(os.path.join(sysfsPath, "dev"))
+    major, sep, minor = text.partition(":")
+    if not sep or not major.isdigit() or not minor.isdigit():
+        return -1
+    return os.makedev(int(major), int(minor))
+
+def getSubDevicePaths(basePath, matchStr):
+    """
+    Returns the sysfs paths and names of the partitions or holders of a
+    block device as list of tuples.
+    """
+    entries = glob.glob(basePath + matchStr)
+    # the holder names relative to the input block path
+    return [(path, path[len(basePath):]) for path in entries
+            if os.path.isdir(path)]
+
+def blockFingerprint(sysfsPath, devName):
+    """
+    Returns the fingerprint of the block device at the given sysfs path,
+    as BlockDevice.fingerprint(), but read from sysfs directly.
+    A device removed meanwhile has a fingerprint of its own.
+    """
+    sysfsPath = os.path.realpath(sysfsPath) + os.sep
+    devNum = getDevNum(sysfsPath)
+    if devNum < 0:
+        return (sysfsPath, devNum) # gone
+    ioFiles = deviceFileCache().getDeviceFiles(devNum)
+    subPaths = (getSubDevicePaths(sysfsPath, devName+"*") +
+                getSubDevicePaths(sysfsPath+"holders"+os.sep, "*"))
+    children = [blockFingerprint(path, name) for path, name in subPaths]
+    return (sysfsPath, devNum, getSize(sysfsPath) or -1, tuple(ioFiles),
+            tuple(status().getMountPoints(devNum, ioFiles)), tuple(children))
+
+def scsiFingerprint(path, scsiStr):
+    """
+    Returns the fingerprint of a scsi device as ScsiDevice.fingerprint(),
+    but read from sysfs directly.
+    """
+    devPath = os.path.realpath(os.path.join(path, scsiStr, "device"))
+    blkPath, name = getBlkDevPath(devPath)
+    if not blkPath or not name:
+        return (devPath, None)
+    return (devPath, blockFingerprint(blkPath, name))
 
 def getSize(sysfsPath):
     """
@@ -691,9 +2141,11 @@ def getSize(sysfsPath):
 class ScsiDevice(Device):
     _scsiAdr = None # list with <host> <channel> <id> <lun>
     _dev = None     # associated Block device object
+    # read on first access, None if not read yet
     _driverName = None
     _vendor = None
     _model = None
+    _snapshot = None
 
     # getter methods
 
@@ -731,7 +2183,13 @@ class ScsiDevice(Device):
     def flush(self):
         return self._dev.flush()
 
-    def __init__(self, path, scsiStr):
+    @traced("ScsiDevice")
+    def __init__(self, path, scsiStr, reuse = None):
+        """
+        Identifies the scsi device and its block device, the remaining
+        information is read on first access. Unchanged block devices
+        in the reuse dictionary (see BlockDevice) are kept.
+        """
         Device.__init__(self, os.path.join(path, scsiStr, "device"))
         self._scsiAdr = scsiStr.split(":")
         if not self.isSupported():
@@ -741,17 +2199,26 @@ class ScsiDevice(Device):
         if not name or not path:
             # throw exception
             raise MyError("Could not determine block device path in /sys/")
-        self._dev = BlockDevice(path, name)
-        self.driver()
-        self.vendor()
-        self.model()
-        self.timeStamp()
+        self._dev = BlockDevice(path, name, reuse)
         # final verification
         if not self.isValid():
             raise MyError("Determined Scsi device information not valid")
 
+    def fingerprint(self):
+        """Identifies the state of this device, see BlockDevice."""
+        return (self.sysfs(), self._dev.fingerprint())
+
+    def snapshot(self):
+        """Returns the state of this device as ScsiSnapshot."""
+        blk = self._dev.snapshot()
+        if self._snapshot is None or self._snapshot.blk is not blk:
+            self._snapshot = ScsiSnapshot(self.sysfs(), self.scsiStr(),
+                    self.driver(), self.vendor(), self.model(),
+                    self.timeStamp(), self.inUse(), blk)
+        return self._snapshot
+
     def model(self):
-        if self._model and len(self._model) > 0:
+        if self._model is not None:
             return self._model
         self._model = ""
         fn = os.path.join(self.sysfs(),"model")
@@ -762,7 +2229,7 @@ class ScsiDevice(Device):
         return self._model
 
     def vendor(self):
-        if self._vendor and len(self._vendor) > 0:
+        if self._vendor is not None:
             return self._vendor
         self._vendor = ""
         fn = os.path.join(self.sysfs(),"vendor")
@@ -773,7 +2240,7 @@ class ScsiDevice(Device):
         return self._vendor
 
     def driver(self):
-        if self._driverName and len(self._driverName) > 0:
+        if self._driverName is not None:
             return self._driverName
         sysfsPath = self._dev.sysfs()
         if not os.path.isdir(sysfsPath):
@@ -811,13 +2278,24 @@ class ScsiDevice(Device):
                 self._dev.isValid())
         # test for every blk device being valid
 
-    def remove(self):
+    def remove(self, umountTimeout = REMOVAL_UMOUNT_TIMEOUT,
+               deleteTimeout = REMOVAL_DELETE_TIMEOUT):
+        """
+        Umounts, flushes and deletes this device. Waits for the kernel to
+        complete the umount and the deletion, up to the given number of
+        seconds each. Raises RemovalSuccessInfo on success.
+        """
         if self.inUse():
-            self.umount()
-        ts = time.time()
-        # wait a sec
-        while self.inUse() and time.time() < ts+1.5:
-            time.sleep(0.1)
+            try:
+                watcher = ProcFileWatcher(OS_MOUNTINFO_PATH)
+            except MyError:
+                watcher = None
+            try:
+                self.umount()
+                self.waitUnused(watcher, umountTimeout)
+            finally:
+                if watcher is not None:
+                    watcher.close()
         # still in use
         if self.inUse():
             raise MyError("Could not umount this device!")
@@ -828,15 +2306,33 @@ class ScsiDevice(Device):
                 raise MyError("Could not find '"+delPath+"'")
             else:
                 self._dev.flush()
+                watcher = RemovalWatcher(self.sysfs())
                 try:
-                    cmd = SysCmd(["sh -c 'echo 1 > "+delPath+"'"], True)
-                    cmd.output()
-                except CmdReturnCodeError, e:
-                    raise MyError(str(e))
-                else:
-                    time.sleep(0.1)
-                    if not self.isValid():
+                    privileged("delete", delPath)
+                    if watcher.wait(deleteTimeout):
                         raise RemovalSuccessInfo()
+                finally:
+                    watcher.close()
+                raise MyError("The device was not removed within {0}s"
+                              .format(deleteTimeout))
+
+    def waitUnused(self, watcher, timeout):
+        """
+        Waits up to timeout seconds for this device to become unused,
+        checks on every change of the mount table signaled by the given
+        ProcFileWatcher. Polls without it.
+        """
+        deadline = time.time() + timeout
+        while True:
+            status().mountStatusChanged()
+            self._dev.update()
+            remaining = deadline - time.time()
+            if not self.inUse() or remaining <= 0:
+                return
+            if watcher is not None:
+                watcher.changed(remaining)
+            else:
+                time.sleep(min(remaining, REMOVAL_POLL_INTERVAL))
 
     def __str__(self):
         """Outputs full detailed information about this devices"""
@@ -844,12 +2340,62 @@ class ScsiDevice(Device):
             return "not valid!"
         output = (str(self._scsiAdr) +
                 ", in use: " + str(self._dev.inUse()) +
-                ", driver: " + str(self._driverName) +
-                ", vendor: " + str(self._vendor) +
-                ", model: " + str(self._model) +
+                ", driver: " + str(self.driver()) +
+                ", vendor: " + str(self.vendor()) +
+                ", model: " + str(self.model()) +
                 "\n" + str(self._dev))
         return output
 
+def runConcurrently(fct, items, workers):
+    """
+    Calls the function for every item in threads, at most the given number
+    at a time. Returns a list of (item, exception) tuples in the order
+    given, the exception is None if the call returned normally.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = range(0, len(items))
+    lock = threading.Lock()
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                i = pending.pop(0)
+            finally:
+                lock.release()
+            try:
+                fct(items[i])
+            except Exception, e:
+                results[i] = (items[i], e)
+            else:
+                results[i] = (items[i], None)
+    threads = [threading.Thread(target = worker)
+               for dummy in range(0, min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def removeDevice(dev):
+    """Removes a scsi device, raises an exception if that failed."""
+    try:
+        dev.remove()
+    except RemovalSuccessInfo:
+        return
+    raise MyError("The device is still present")
+
+def removeDevices(devices, workers = REMOVAL_WORKERS):
+    """
+    Removes several scsi devices (umount, flush, delete) concurrently,
+    at most the given number at a time. Returns a list of
+    (device, exception) tuples in the order given, the exception is None
+    for devices removed successfully.
+    """
+    return runConcurrently(removeDevice, devices, workers)
+
 def getBlkDevPath(devPath):
     """
     Returns the scsi block device path.
@@ -872,89 +2418,436 @@ def getBlkDevPath(devPath):
     return (fullPath, devName)
 
 class DeviceFileCache(object):
-# how to improve this ? is there a direct way to get the device file ?
-# speedup by caching ?
+    """
+    Device files in /dev/ by block device number. Device files are
+    resolved per device from sysfs and the udev database, a full scan
+    of /dev/ is the fallback if these are not available.
+    Changes in /dev/ are applied entry by entry as reported by inotify.
+    """
     _cache = None
+    _names = None # device numbers by device file name
+    _missing = None # generations device numbers were not found in
+    _inotify = None # Inotify on /dev/ and its subdirectories, if available
+    _generation = None # number of changes applied so far
+    _lock = None # used by concurrent removals, see removeDevices()
 
     def __init__(self):
+        self._lock = threading.RLock()
         self._cache = dict()
-        self.rebuild()
+        self._names = dict()
+        self._missing = dict()
+        self._generation = 0
+        try:
+            self._inotify = Inotify()
+        except MyError, e:
+            logging.info(str(e)+", device files are not tracked")
+            self._inotify = None
+        else:
+            for pattern in DEV_WATCH_DIRS:
+                for path in glob.glob(os.path.join(OS_DEV_PATH, pattern)):
+                    self.watch(path)
+
+    def close(self):
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+    def watch(self, path):
+        """Tracks the device files in the given directory by inotify."""
+        path = os.path.normpath(path)
+        if (not self._inotify or path in self._inotify.watched() or
+            not os.path.isdir(path)):
+            return
+        self._inotify.addWatch(path, DEV_WATCH_MASK)
+
+    def generation(self):
+        """
+        Returns a counter increased by every change of the cached device
+        files. Names retrieved before are still current if it did not change.
+        """
+        self._lock.acquire()
+        try:
+            self.processEvents()
+            return self._generation
+        finally:
+            self._lock.release()
 
     def getDeviceFiles(self, devnum):
         """
         Search the block device filename in /dev/ based on the major/minor
-        number.
+        number. Returns an empty list for invalid numbers.
         """
-        # retrieve the io file if available
-        if devnum not in self._cache:
-            self.rebuild()
-        names = self._cache.get(devnum, [])
-        return names
-
+        if devnum is None or devnum < 0:
+            return []
+        self._lock.acquire()
+        try:
+            self.processEvents()
+            # retrieve the io file if available
+            if devnum in self._cache:
+                metrics().count("dfmon_device_file_cache_total",
+                                result = "hit")
+            elif self._missing.get(devnum) == self._generation:
+                metrics().count("dfmon_device_file_cache_total",
+                                result = "negative")
+            elif self.resolve(devnum) is not None:
+                metrics().count("dfmon_device_file_cache_total",
+                                result = "resolved")
+            elif os.path.isdir(OS_SYS_DEV_BLOCK_PATH):
+                # sysfs lists every block device, this one is gone
+                metrics().count("dfmon_device_file_cache_total",
+                                result = "gone")
+            else:
+                metrics().count("dfmon_device_file_cache_total",
+                                result = "miss")
+                self.rebuild()
+                if devnum not in self._cache: # until /dev/ changes
+                    self._missing[devnum] = self._generation
+            names = self._cache.get(devnum, [])
+            return list(names) # the cached list changes on updates
+        finally:
+            self._lock.release()
+
+    def resolve(self, devnum):
+        """
+        Determines the device files of a single block device directly:
+        the kernel name (DEVNAME in /sys/dev/block/MAJ:MIN/uevent),
+        /dev/block/MAJ:MIN and the symlinks listed in the udev database
+        (/run/udev/data/bMAJ:MIN). Returns the list of files found or None,
+        if the kernel does not provide information about this device.
+        """
+        devId = "{0}:{1}".format(os.major(devnum), os.minor(devnum))
+        try:
+            uevent = readProcFile(os.path.join(OS_SYS_DEV_BLOCK_PATH,
+                                               devId, "uevent"))
+        except MyError:
+            return None
+        candidates = []
+        for line in uevent.splitlines():
+            if line.startswith("DEVNAME="):
+                candidates.append(os.path.join(OS_DEV_PATH, line[8:]))
+        candidates.append(os.path.join(OS_DEV_PATH, "block", devId))
+        try:
+            udevData = readProcFile(os.path.join(OS_UDEV_DATA_PATH,
+                                                 "b"+devId))
+        except MyError:
+            udevData = "" # udev not running
+        for line in udevData.splitlines():
+            # device node name (old udev) and symlinks, relative to /dev/
+            if line.startswith("N:") or line.startswith("S:"):
+                candidates.append(os.path.join(OS_DEV_PATH, line[2:]))
+        for fn in self._cache.pop(devnum, []):
+            self._names.pop(fn, None)
+        for fn in candidates:
+            if self.addFile(fn, devnum):
+                self.watch(os.path.dirname(fn))
+        return self._cache.get(devnum, [])
+
+    def processEvents(self):
+        """Applies the changes in /dev/ reported since the last call."""
+        if not self._inotify:
+            return
+        for path, mask in self._inotify.events():
+            if mask & IN_Q_OVERFLOW:
+                # changes were lost, resolve everything again on demand
+                self._cache.clear()
+                self._names.clear()
+                self._generation += 1
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch(path) # e.g. a new /dev/disk/by-* directory
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                if self.remove(path):
+                    self._generation += 1
+            elif mask & (IN_CREATE | IN_MOVED_TO | IN_ATTRIB):
+                changed = self.remove(path)
+                # add names of devices already resolved only
+                statinfo = self.statFile(path)
+                if (statinfo and
+                    self._missing.pop(statinfo[0], None) is not None):
+                    changed = True # a file of a device not found before
+                if statinfo and statinfo[0] in self._cache:
+                    self.add(statinfo[0], path, statinfo[1])
+                    changed = True
+                if changed:
+                    self._generation += 1
+
+    @traced("DeviceFileCache.rebuild")
     def rebuild(self):
-        self._cache.clear()
-        for root, dirs, files in os.walk(OS_DEV_PATH):
-            # ignore directories with leading dot
-            for i in reversed(range(0, len(dirs))):
-                if dirs[i][0] == "." or dirs[i] == "input":
-                    del dirs[i]
-            # add the files found to a list
-            for fn in files:
-                # ignore some files
-                if fn[:3] == "pty" or fn[:3] == "tty" or fn[:3] == "ram":
-                    continue
-                fullname = os.path.join(root, fn)
-                prepend = True
-                try:
-                    statinfo = os.lstat(fullname) # don't follow symbolic link
-                    if stat.S_ISLNK(statinfo.st_mode):
-                        statinfo = os.stat(fullname) # follow symbolic link
-                        prepend = False
-                except OSError, e:
-                    print "Can't stat", fullname, "->", str(e)
-                    continue
-                # consider block devices only, take dev numbers for the keys
-                if not stat.S_ISBLK(statinfo.st_mode):
-                    continue
-                self.add(statinfo.st_rdev, fullname, prepend)
+        self._lock.acquire()
+        start = time.time()
+        try:
+            self._cache.clear()
+            self._names.clear()
+            self._missing.clear()
+            self._generation += 1
+            for root, dirs, files in os.walk(OS_DEV_PATH):
+                # ignore directories with leading dot
+                for i in reversed(range(0, len(dirs))):
+                    if dirs[i][0] == "." or dirs[i] == "input":
+                        del dirs[i]
+                # add the files found to a list
+                for fn in files:
+                    # ignore some files
+                    if fn[:3] in ("pty", "tty", "ram"):
+                        continue
+                    self.addFile(os.path.join(root, fn))
+        finally:
+            metrics().observe("dfmon_device_file_cache_rebuild_seconds",
+                              time.time() - start)
+            self._lock.release()
+
+    def statFile(self, fullname):
+        """
+        Returns the device number of a block device file and True,
+        or False for a link to it. None for other files.
+        """
+        try:
+            isNode = not os.path.islink(fullname)
+            devNum = blockDeviceNumber(fullname)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                print "Can't stat", fullname, "->", str(e)
+            return None
+        # consider block devices only, take dev numbers for the keys
+        if devNum is None:
+            return None
+        return (devNum, isNode)
+
+    def addFile(self, fullname, devnum = None):
+        """
+        Adds a block device file or a link to it, if it belongs to the given
+        device number (any, if None). Returns True if it was added.
+        """
+        statinfo = self.statFile(fullname)
+        if not statinfo:
+            return False
+        if devnum is not None and statinfo[0] != devnum:
+            return False
+        # device nodes first, links afterwards
+        self.add(statinfo[0], fullname, statinfo[1])
+        return True
 
     def add(self, key, value, prepend = False):
+        if value in self._names:
+            return
         lst = self._cache.get(key, [])
         if prepend:
             lst.insert(0, value)
         else:
             lst.append(value)
         self._cache[key] = lst
+        self._names[value] = key
+
+    def remove(self, value):
+        """Removes a device file name, returns True if it was known."""
+        key = self._names.pop(value, None)
+        if key is None:
+            return False
+        lst = self._cache.get(key, [])
+        if value in lst:
+            lst.remove(value)
+        if not lst:
+            self._cache.pop(key, None) # resolve again on next lookup
+        return True
+
+def isConcerned(dev, paths):
+    """
+    Tells if a change at one of the sysfs paths concerns a scsi device,
+    its block device or their sub-devices.
+    """
+    if not paths:
+        return False
+    devPaths = [p.rstrip(os.sep)+os.sep
+                for p in [dev.sysfs()] + dev.blk().subtree().keys()]
+    for path in paths:
+        path = path.rstrip(os.sep)+os.sep
+        for devPath in devPaths:
+            if path.startswith(devPath):
+                return True
+    return False
 
-def getScsiDevices(path):
+@traced("getScsiDevices")
+def getScsiDevices(path, previous = None, changed = None):
     """
-    Returns a list of scsi device descriptors including block devices
+    Returns a list of scsi device descriptors including block devices.
+    Devices of a previous list are reused if their fingerprint did not
+    change, changed ones are rebuilt reusing their unchanged parts.
+    If the sysfs paths changed since the previous list are known (see
+    Status.changedPaths()), the devices not concerned are reused without
+    reading them again. Raises MyError if the path does not exist.
     """
     if not os.path.isdir(path):
-        return
+        raise MyError("Specified device path '{0}' does not exist !"
+                      .format(path))
+    previousDevs = dict()
+    for dev in previous or []:
+        if changed is None:
+            previousDevs[dev.sysfs()] = dev
+        else: # known by their entry, addresses reused are reported
+            previousDevs[dev.scsiStr()[1:-1]] = dev
     devs = []
     entries = os.listdir(path)
     for entry in entries:
+        if changed is None:
+            old = previousDevs.get(
+                    os.path.realpath(os.path.join(path, entry, "device")))
+        else:
+            old = previousDevs.get(entry)
         try:
-            d = ScsiDevice(path, entry)
+            if old is None:
+                d = ScsiDevice(path, entry)
+            elif ((changed is not None and not isConcerned(old, changed))
+                  or old.fingerprint() == scsiFingerprint(path, entry)):
+                d = old
+            else:
+                d = ScsiDevice(path, entry, old.blk().subtree())
         except MyError, e:
             logging.warning("Init failed for "+entry+": "+str(e))
             continue
         else:
-            assert d.isValid(), "Device not valid: "+entry
-            # add the device in chronological order
-            i = 0
-            for oldDev in devs:
-                if oldDev.timeStamp() < d.timeStamp():
-                    break
-                i += 1
-            devs.insert(i, d)
+            assert d is old or d.isValid(), "Device not valid: "+entry
+            devs.append(d)
+    # the most recent devices first, stable for equal times
+    devs.sort(key = lambda dev: dev.timeStamp(), reverse = True)
     return devs
 
-# dictionary for io filename lookup and caching
-DEVICE_FILE_CACHE = DeviceFileCache()
-
-# get initial system status
-STATUS = Status()
+def setRoot(root = "/"):
+    """
+    Redirects the system paths below the given directory, e.g. to a tree
+    generated by benchmark.py. Block device files can't be created there,
+    their numbers are listed in the file DEV_NODES_FILE instead, see
+    readDevNodes(). Drops the device file cache and the system status,
+    they are created again on demand.
+    """
+    global ROOT_PATH, DEV_NODES, _DEVICE_FILE_CACHE, _STATUS
+    root = os.path.realpath(root)
+    for name in OS_PATH_NAMES:
+        path = globals()[name][len(ROOT_PATH.rstrip(os.sep)):]
+        globals()[name] = root.rstrip(os.sep) + path
+    ROOT_PATH = root
+    DEV_NODES = None
+    if ROOT_PATH != os.sep:
+        DEV_NODES = readDevNodes(os.path.join(ROOT_PATH, DEV_NODES_FILE))
+    if _DEVICE_FILE_CACHE is not None:
+        _DEVICE_FILE_CACHE.close()
+    _DEVICE_FILE_CACHE = None
+    _STATUS = None
+
+# asking for the sudo password from several threads, see SysCmd
+SUDO_PWD_LOCK = threading.Lock()
+
+# privileged helper process, False if not available, see helper()
+_HELPER = None
+_HELPER_LOCK = threading.Lock()
+
+# counters and latencies, see metrics()
+_METRICS = None
+_METRICS_LOCK = threading.Lock()
+
+# spans recorded, None unless enabled, see enableTracing()
+_TRACER = None
+
+# dictionary for io filename lookup and caching, see deviceFileCache()
+_DEVICE_FILE_CACHE = None
+_DEVICE_FILE_CACHE_LOCK = threading.Lock()
+
+# system status, see status()
+_STATUS = None
+_STATUS_LOCK = threading.Lock()
+
+def helper():
+    """
+    Returns the PrivilegedHelper, started on first use. None if it is not
+    available, starting it is not tried again then.
+    """
+    global _HELPER
+    _HELPER_LOCK.acquire() # one password question
+    try:
+        if _HELPER is None:
+            try:
+                _HELPER = PrivilegedHelper()
+            except MyError, e:
+                logging.warning(str(e)+", running privileged commands "
+                                "one by one")
+                _HELPER = False
+        return _HELPER or None
+    finally:
+        _HELPER_LOCK.release()
+
+def privileged(op, *args):
+    """
+    Runs an operation of the privileged helper (see helper.py) and returns
+    its output. The equivalent system command is run by the sudo handler
+    if the helper is not available. Raises MyError if it failed.
+    """
+    if ROOT_PATH != os.sep:
+        raise MyError("System commands are disabled for a "
+                      "redirected root (replay)")
+    privHelper = helper()
+    if privHelper is not None and privHelper.isRunning():
+        start = time.time()
+        try:
+            return privHelper.call(op, *args)
+        finally:
+            metrics().observe("dfmon_helper_call_seconds",
+                              time.time() - start, operation = op)
+    if op == "umount":
+        cmdList = ["umount"] + list(args)
+    elif op == "flush":
+        cmdList = ["/sbin/blockdev", "--flushbufs"] + list(args)
+    elif op == "delete":
+        cmdList = ["sh -c 'echo 1 > "+args[0]+"'"]
+    elif op == "truecrypt":
+        cmdList = ["truecrypt"] + list(args)
+    else:
+        raise MyError("Unknown privileged operation: "+op)
+    try:
+        return "".join(SysCmd(cmdList, True).output())
+    except CmdReturnCodeError, e:
+        raise MyError(str(e))
+
+def metrics():
+    """Returns the Metrics registry, created on first use."""
+    global _METRICS
+    if _METRICS is None:
+        _METRICS_LOCK.acquire()
+        try:
+            if _METRICS is None:
+                _METRICS = Metrics()
+        finally:
+            _METRICS_LOCK.release()
+    return _METRICS
+
+def deviceFileCache():
+    """Returns the DeviceFileCache, created on first use."""
+    global _DEVICE_FILE_CACHE
+    if _DEVICE_FILE_CACHE is None:
+        _DEVICE_FILE_CACHE_LOCK.acquire()
+        try:
+            if _DEVICE_FILE_CACHE is None:
+                _DEVICE_FILE_CACHE = DeviceFileCache()
+        finally:
+            _DEVICE_FILE_CACHE_LOCK.release()
+    return _DEVICE_FILE_CACHE
+
+def setStatus(statusObj):
+    """Replaces the system Status, e.g. by a daemon.RemoteStatus."""
+    global _STATUS
+    _STATUS = statusObj
+
+def status():
+    """
+    Returns the system Status, created on first use. Raises MyError if
+    the system is not supported.
+    """
+    global _STATUS
+    if _STATUS is None:
+        _STATUS_LOCK.acquire() # the GUI and the IoThread start at once
+        try:
+            if _STATUS is None:
+                _STATUS = Status()
+        finally:
+            _STATUS_LOCK.release()
+    return _STATUS
 
 # vim: set ts=4 sts=4 sw=4 tw=0:
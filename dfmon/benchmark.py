@@ -0,0 +1,790 @@
+# -*- coding: utf-8 -*-
+# benchmark.py
+#
+# Copyright (c) 2010-2011, Ingo Breßler <dfmon@ingobressler.net>
+#
+# This file is part of dfmon.
+#
+# dfmon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dfmon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dfmon.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Performance measurements for dfmon (developer tool).
+
+The backend is timed on generated system trees (see makeFixture()),
+the results are compared to a baseline stored by a previous run on the
+same host to catch regressions. The uevent parsing is checked against
+recorded payloads first (see checkUevents()).
+
+Usage:
+    $ python dfmon/benchmark.py [-s] [-b <baseline file>] [-n <disks,..>]
+                                [-r <capture file>]
+    -s  stores the results as the new baseline
+    -b  baseline file, benchmark.baseline next to this file by default
+    -n  numbers of disks to generate, "10,100,1000" by default
+    -r  times a capture of a host as well, see 'dfmon --capture'
+
+The GUI tree (build and refresh) is timed only if PyQt4 is available,
+otherwise it is reported as skipped.
+"""
+
+import sys
+import os
+import time
+import new
+import getopt
+import shutil
+import socket
+import tempfile
+import subprocess
+import threading
+import backend
+import uicmd
+
+# device numbers of the fixtures, the disk major is made up to fit
+# any number of disks
+FIXTURE_DISK_MAJOR = 1024
+FIXTURE_DM_MAJOR = 253
+FIXTURE_MINORS = 16 # per disk, for the partitions
+FIXTURE_SIZE = 2048 # in blocks, per partition
+
+# results slower than the baseline by this factor are regressions,
+# differences below the minimum (in seconds) are noise
+REGRESSION_FACTOR = 1.5
+REGRESSION_MIN = 0.002
+# startup time limits in seconds, without Qt
+STARTUP_BUDGETS = [("dfmon -h", "dfmon.main(['dfmon', '-h'])", 0.1),
+                   ("console mode import", "import dfmon.uicmd", 0.1)]
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "benchmark.baseline")
+
+class FakeBlockDevice(object):
+    """Stands in for a backend.BlockDevice, no system access."""
+
+    def __init__(self, path, size, partitions = None):
+        self._path = path
+        self._size = size
+        self._partitions = partitions
+        if not self._partitions:
+            self._partitions = []
+        self._snapshot = None
+
+    def sysfs(self):
+        return self._path
+
+    def shortName(self):
+        return self._path.rstrip("/").split("/")[-1]
+
+    def fullName(self):
+        return "/dev/"+self.shortName()
+
+    def ioFiles(self):
+        return [self.fullName()]
+
+    def mountPoints(self):
+        return []
+
+    def mountPoint(self):
+        return ""
+
+    def size(self):
+        return self._size
+
+    def partitions(self):
+        return self._partitions
+
+    def holders(self):
+        return []
+
+    def inUse(self):
+        return False
+
+    def isBlock(self):
+        return True
+
+    def isScsi(self):
+        return False
+
+    def snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = backend.BlockSnapshot(self._path,
+                    self.shortName(), 0, self._size, tuple(self.ioFiles()),
+                    (), False, 0,
+                    tuple([p.snapshot() for p in self._partitions]), ())
+        return self._snapshot
+
+class FakeScsiDevice(object):
+    """Stands in for a backend.ScsiDevice, no system access."""
+
+    def __init__(self, path, blk):
+        self._path = path
+        self._blk = blk
+        self._snapshot = None
+
+    def sysfs(self):
+        return self._path
+
+    def blk(self):
+        return self._blk
+
+    def shortName(self):
+        return "["+self._path.split("/")[-1]+"]"
+
+    def fullName(self):
+        return self.shortName()+" "+self.model()
+
+    def model(self):
+        return "Fake Disk"
+
+    def timeStamp(self):
+        return int(time.time())
+
+    def inUse(self):
+        return False
+
+    def isBlock(self):
+        return False
+
+    def isScsi(self):
+        return True
+
+    def snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = backend.ScsiSnapshot(self._path,
+                    self.shortName(), "", "", self.model(), self.timeStamp(),
+                    False, self._blk.snapshot())
+        return self._snapshot
+
+def fakeDevices(count, partitions = 2):
+    """Returns a list of fake scsi devices with partitioned disks."""
+    devices = []
+    for i in range(0, count):
+        path = "/sys/devices/fake/{0}:0:0:0".format(i)
+        blkPath = path+"/block/sd{0}/".format(i)
+        parts = [FakeBlockDevice(blkPath+"sd{0}p{1}/".format(i, p), 1024)
+                 for p in range(0, partitions)]
+        devices.append(FakeScsiDevice(path,
+                       FakeBlockDevice(blkPath, 1024*partitions, parts)))
+    return devices
+
+def changeDevices(devices, changes):
+    """
+    Returns a copy of the device list with the given number of devices
+    changed (first partition resized). Like the backend, unchanged devices
+    and partitions are the same objects.
+    """
+    result = list(devices)
+    step = max(1, len(devices) // max(1, changes))
+    for i in range(0, len(devices), step)[:changes]:
+        blk = devices[i].blk()
+        parts = list(blk.partitions())
+        parts[0] = FakeBlockDevice(parts[0].sysfs(), parts[0].size()+1)
+        result[i] = FakeScsiDevice(devices[i].sysfs(),
+                        FakeBlockDevice(blk.sysfs(), blk.size(), parts))
+    return result
+
+def loadedDevices(count, partitions = 2):
+    """
+    Returns a list of backend.ScsiDevices with partitioned disks in the
+    state after everything was read, without system access.
+    """
+    def blockDevice(path, name, devNum, size, parts):
+        return new.instance(backend.BlockDevice, dict(
+                    _sysfsPath = path, _devName = name, _devNum = devNum,
+                    _size = long(size), _ioFiles = ["/dev/"+name],
+                    _mountPoints = [], _timeStamp = int(time.time()),
+                    _inUse = False, _partitions = parts, _holders = []))
+    devices = []
+    for i in range(0, count):
+        path = "/sys/devices/fake/{0}:0:0:0".format(i)
+        blkPath = path+"/block/sd{0}/".format(i)
+        devNum = (8 << 8) + i*(partitions+1)
+        parts = [blockDevice(blkPath+"sd{0}p{1}/".format(i, p),
+                             "sd{0}p{1}".format(i, p), devNum+p+1, 1024, [])
+                 for p in range(0, partitions)]
+        blk = blockDevice(blkPath, "sd{0}".format(i), devNum,
+                          1024*partitions, parts)
+        devices.append(new.instance(backend.ScsiDevice, dict(
+                    _sysfsPath = path, _scsiAdr = [str(i), "0", "0", "0"],
+                    _dev = blk, _driverName = "sd", _vendor = "ACME",
+                    _model = "Fake Disk")))
+    return devices
+
+def deepSize(obj, seen = None):
+    """
+    Returns the memory used by an object including the containers,
+    instances and values it refers to. Shared objects are counted once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deepSize(key, seen) + deepSize(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deepSize(item, seen)
+    elif hasattr(obj, "__dict__"):
+        size += deepSize(obj.__dict__, seen)
+    return size
+
+def benchDeviceMemory(count = 5000):
+    """
+    Compares the memory per scsi device (with a disk and two partitions)
+    used by the device objects and by their snapshots. Returns a tuple:
+    (devices, bytes per device object, bytes per snapshot)
+    """
+    devices = loadedDevices(count)
+    objects = deepSize(devices) - deepSize([])
+    snapshots = tuple([dev.snapshot() for dev in devices])
+    snapshots = deepSize(snapshots) - deepSize(())
+    return (count, objects / count, snapshots / count)
+
+def sdName(i):
+    """Returns the kernel name of the i-th scsi disk: sda .. sdz, sdaa .."""
+    name = ""
+    i += 1
+    while i > 0:
+        i, rest = divmod(i-1, 26)
+        name = chr(ord("a")+rest) + name
+    return "sd"+name
+
+def writeFile(path, text):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fd = open(path, "w")
+    fd.write(text)
+    fd.close()
+
+def linkTo(target, path):
+    """Creates a relative symbolic link at path, like sysfs does."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    os.symlink(os.path.relpath(target, os.path.dirname(path)), path)
+
+def makeBlockDir(root, path, name, devNum, size, devType):
+    """
+    Creates the sysfs directory of a block device, its links and device
+    file. Returns its line of the device node table.
+    """
+    devId = "{0}:{1}".format(os.major(devNum), os.minor(devNum))
+    writeFile(os.path.join(path, "dev"), devId+"\n")
+    writeFile(os.path.join(path, "size"), str(size)+"\n")
+    writeFile(os.path.join(path, "uevent"),
+              "MAJOR={0}\nMINOR={1}\nDEVNAME={2}\nDEVTYPE={3}\n"
+              .format(os.major(devNum), os.minor(devNum), name, devType))
+    os.makedirs(os.path.join(path, "holders"))
+    linkTo(path, os.path.join(root, "sys", "dev", "block", devId))
+    writeFile(os.path.join(root, "dev", name), "")
+    return devId+" /dev/"+name+"\n"
+
+def mountInfoLine(mountId, devNum, mountPoint, source):
+    return ("{0} 20 {1}:{2} / {3} rw,relatime - ext4 {4} rw\n"
+            .format(mountId, os.major(devNum), os.minor(devNum),
+                    mountPoint, source))
+
+def makeFixture(root, disks, partitions = 2, holders = 0):
+    """
+    Creates a system tree below root as read by the backend, see
+    backend.setRoot(): scsi disks with partitions in sysfs, their device
+    files and links in /dev, the udev database and mount and swap tables.
+    The first partition of every other disk is mounted, the second one of
+    the first disk is used as swap. The last partitions of the first disks
+    hold a mounted device-mapper device each, as many as given.
+    """
+    sysDevices = os.path.join(root, "sys", "devices")
+    devNodes = ""
+    mountInfo = "20 1 0:1 / / rw - rootfs rootfs rw\n"
+    swaps = "Filename\tType\tSize\tUsed\tPriority\n"
+    # the scsi driver, see backend.ScsiDevice.driver()
+    driver = os.path.join(root, "sys", "bus", "scsi", "drivers", "fixture")
+    os.makedirs(driver)
+    linkTo(driver, os.path.join(sysDevices, "fixture", "driver"))
+    for i in range(0, disks):
+        host, target = divmod(i, 64)
+        scsiStr = "{0}:0:{1}:0".format(host, target)
+        scsiDir = os.path.join(sysDevices, "fixture", "host{0}".format(host),
+                               "target{0}:0:{1}".format(host, target),
+                               scsiStr)
+        writeFile(os.path.join(scsiDir, "type"), "0\n")
+        writeFile(os.path.join(scsiDir, "vendor"), "FIXTURE\n")
+        writeFile(os.path.join(scsiDir, "model"), "Disk {0}\n".format(i))
+        linkTo(scsiDir, os.path.join(root, "sys", "class", "scsi_device",
+                                     scsiStr, "device"))
+        name = sdName(i)
+        blkDir = os.path.join(scsiDir, "block", name)
+        devNum = os.makedev(FIXTURE_DISK_MAJOR + i // FIXTURE_MINORS,
+                            (i % FIXTURE_MINORS) * FIXTURE_MINORS)
+        devNodes += makeBlockDir(root, blkDir, name, devNum,
+                                 FIXTURE_SIZE*partitions, "disk")
+        linkTo(scsiDir, os.path.join(blkDir, "device"))
+        linkTo(blkDir, os.path.join(root, "sys", "block", name))
+        # persistent name, as created by udev
+        diskId = "disk/by-id/scsi-FIXTURE_{0}".format(i)
+        linkTo(os.path.join(root, "dev", name),
+               os.path.join(root, "dev", diskId))
+        writeFile(os.path.join(root, "run", "udev", "data",
+                               "b{0}:{1}".format(os.major(devNum),
+                                                 os.minor(devNum))),
+                  "S:"+diskId+"\n")
+        for p in range(1, partitions+1):
+            partName = name+str(p)
+            partDir = os.path.join(blkDir, partName)
+            partNum = os.makedev(os.major(devNum), os.minor(devNum)+p)
+            devNodes += makeBlockDir(root, partDir, partName, partNum,
+                                     FIXTURE_SIZE, "partition")
+            writeFile(os.path.join(partDir, "partition"), str(p)+"\n")
+            if p == 1 and i % 2 == 0:
+                mountInfo += mountInfoLine(len(mountInfo.splitlines())+20,
+                                           partNum, "/mnt/fixture/"+partName,
+                                           "/dev/"+partName)
+            elif p == 2 and i == 0:
+                swaps += "/dev/{0}\tpartition\t{1}\t0\t-2\n".format(
+                            partName, FIXTURE_SIZE/2)
+            if p < partitions or i >= holders:
+                continue
+            dmName = "dm-{0}".format(i)
+            dmDir = os.path.join(sysDevices, "virtual", "block", dmName)
+            dmNum = os.makedev(FIXTURE_DM_MAJOR, i)
+            devNodes += makeBlockDir(root, dmDir, dmName, dmNum,
+                                     FIXTURE_SIZE, "disk")
+            linkTo(partDir, os.path.join(dmDir, "slaves", partName))
+            linkTo(dmDir, os.path.join(partDir, "holders", dmName))
+            linkTo(dmDir, os.path.join(root, "sys", "block", dmName))
+            mapperName = "mapper/fixture{0}".format(i)
+            linkTo(os.path.join(root, "dev", dmName),
+                   os.path.join(root, "dev", mapperName))
+            mountInfo += mountInfoLine(len(mountInfo.splitlines())+20,
+                                       dmNum, "/mnt/fixture/"+dmName,
+                                       "/dev/"+mapperName)
+    writeFile(os.path.join(root, backend.DEV_NODES_FILE), devNodes)
+    writeFile(os.path.join(root, "proc", "self", "mountinfo"), mountInfo)
+    writeFile(os.path.join(root, "proc", "swaps"), swaps)
+
+def timeIt(fct, *args):
+    """Returns the duration of a function call in seconds."""
+    start = time.time()
+    fct(*args)
+    return time.time() - start
+
+def benchTreeRefresh(counts = (100, 1000), changesList = (1, 10, 100)):
+    """
+    Compares the in-place tree update with a complete rebuild for
+    a number of devices and changes. Returns a list of result tuples:
+    (devices, changes, update time, rebuild time)
+    Needs PyQt4, see guiAvailable().
+    """
+    from PyQt4.QtGui import QTreeWidget
+    from mytreewidget import syncItems, deviceEntries
+    qtApplication()
+    results = []
+    for count in counts:
+        tree = QTreeWidget()
+        devices = fakeDevices(count)
+        syncItems(tree.invisibleRootItem(), deviceEntries(devices))
+        for changes in changesList:
+            if changes > count:
+                continue
+            devices = changeDevices(devices, changes)
+            entries = deviceEntries(devices) # done by the ioThread
+            update = timeIt(syncItems, tree.invisibleRootItem(), entries)
+            tree.clear()
+            rebuild = timeIt(syncItems, tree.invisibleRootItem(), entries)
+            results.append((count, changes, update, rebuild))
+    return results
+
+def guiAvailable():
+    try:
+        import PyQt4.QtGui
+    except ImportError:
+        return False
+    return True
+
+def qtApplication():
+    from PyQt4.QtGui import QApplication
+    app = QApplication.instance()
+    if app is None:
+        app = QApplication(sys.argv)
+    return app
+
+def scan(status):
+    """Reads all devices and their state, like the GUI does."""
+    for dev in status.getDevices():
+        dev.snapshot()
+
+def printDevices(devices):
+    """Formats the devices like the console mode does."""
+    for dev in devices:
+        uicmd.printBlkDev(dev.blk())
+
+def buildTree(devices):
+    """Builds the GUI device tree from scratch."""
+    from PyQt4.QtGui import QTreeWidget
+    from mytreewidget import syncItems, deviceEntries
+    qtApplication()
+    syncItems(QTreeWidget().invisibleRootItem(), deviceEntries(devices))
+
+def benchStatus(name = ""):
+    """
+    Times the backend on the current root, see backend.setRoot(). Returns
+    a list of result tuples: (name, disks, seconds)
+    """
+    status = backend.status()
+    cold = timeIt(scan, status)
+    devices = status.getDevices()
+    count = len(devices)
+    results = [(name+"scan cold", count, cold),
+               (name+"scan unchanged", count, timeIt(scan, status))]
+    # changes reported by uevents, like on the real root
+    monitor, sender = ueventMonitor()
+    status.setDeviceMonitor(monitor)
+    try:
+        scan(status) # compares all devices once
+        results.append((name+"scan unchanged, uevents", count,
+                        timeIt(scan, status)))
+        if devices:
+            sendUevent(sender, "change", devices[0].blk().sysfs())
+        results.append((name+"scan after a uevent", count,
+                        timeIt(scan, status)))
+    finally:
+        status.setDeviceMonitor(None)
+        monitor.close()
+        sender.close()
+    results.append((name+"printBlkDev", count,
+                    timeIt(printDevices, devices)))
+    if guiAvailable():
+        results.append((name+"tree build", count,
+                        timeIt(buildTree, devices)))
+    results.append((name+"DeviceFileCache.rebuild", count,
+                    timeIt(backend.deviceFileCache().rebuild)))
+    results.append((name+"daemon client", count, benchDaemon()))
+    return results
+
+def ueventMonitor():
+    """
+    Returns a backend.UeventMonitor and the socket feeding it, see
+    sendUevent().
+    """
+    sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    return backend.UeventMonitor(receiver), sender
+
+def sendUevent(sock, action, sysfsPath):
+    """Sends the uevent of a block device like the kernel does."""
+    devPath = os.sep + os.path.relpath(sysfsPath, backend.OS_SYS_PATH_BASE)
+    sock.send("{0}@{1}\0ACTION={0}\0DEVPATH={1}\0SUBSYSTEM=block"
+              .format(action, devPath))
+
+# recorded uevent payloads and the (action, devpath, subsystem) parsed,
+# None if not parsed, see checkUevents()
+UEVENT_SAMPLES = [
+    ("add@/devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1:1.0/host6/"
+     "target6:0:0/6:0:0:0/block/sdb\0ACTION=add\0DEVPATH=/devices/"
+     "pci0000:00/0000:00:14.0/usb2/2-1/2-1:1.0/host6/target6:0:0/6:0:0:0/"
+     "block/sdb\0SUBSYSTEM=block\0MAJOR=8\0MINOR=16\0DEVNAME=sdb\0"
+     "DEVTYPE=disk\0SEQNUM=4242",
+     ("add", "/devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1:1.0/host6/"
+      "target6:0:0/6:0:0:0/block/sdb", "block")),
+    ("remove@/devices/platform/host1/target1:0:0/1:0:0:0\0ACTION=remove\0"
+     "DEVPATH=/devices/platform/host1/target1:0:0/1:0:0:0\0"
+     "SUBSYSTEM=scsi\0DEVTYPE=scsi_device\0SEQNUM=4243",
+     ("remove", "/devices/platform/host1/target1:0:0/1:0:0:0", "scsi")),
+    # not relevant: other subsystem and action
+    ("add@/devices/virtual/net/tun0\0ACTION=add\0DEVPATH=/devices/"
+     "virtual/net/tun0\0SUBSYSTEM=net\0SEQNUM=4244",
+     ("add", "/devices/virtual/net/tun0", "net")),
+    ("bind@/devices/platform/host1\0ACTION=bind\0DEVPATH=/devices/"
+     "platform/host1\0SUBSYSTEM=scsi\0SEQNUM=4245",
+     ("bind", "/devices/platform/host1", "scsi")),
+    # libudev rebroadcasts: binary header, no '@'
+    ("libudev\0\xfe\xed\xca\xfe\x28\x00\x00\x00ACTION=add\0"
+     "DEVPATH=/devices/virtual/block/loop0\0SUBSYSTEM=block", None),
+    # malformed
+    ("", None),
+    ("garbage without separator", None),
+    ("change@/devices/virtual/block/dm-0\0novalue\0=\0SUBSYSTEM=block",
+     ("change", "/devices/virtual/block/dm-0", "block")),
+]
+
+def checkUevents():
+    """
+    Parses the recorded uevent payloads and feeds them to a UeventMonitor,
+    which has to report the relevant ones only. Raises MyError on
+    mismatch.
+    """
+    for payload, expected in UEVENT_SAMPLES:
+        event = backend.parseUevent(payload)
+        if event is not None:
+            event = (event.action(), event.devPath(), event.subsystem())
+        if event != expected:
+            raise backend.MyError("Uevent parsed as {0}: {1}"
+                                  .format(event, repr(payload[:40])))
+    monitor, sender = ueventMonitor()
+    try:
+        for payload, expected in UEVENT_SAMPLES:
+            if payload: # an empty datagram ends the reading
+                sender.send(payload)
+        events = [(event.action(), event.devPath(), event.subsystem())
+                  for event in monitor.events()]
+        expected = [expected for payload, expected in UEVENT_SAMPLES
+                    if expected is not None and
+                       expected[0] in backend.UEVENT_ACTIONS and
+                       expected[2] in backend.UEVENT_SUBSYSTEMS]
+        if events != expected or monitor.lost():
+            raise backend.MyError("UeventMonitor reported: "+str(events))
+    finally:
+        monitor.close()
+        sender.close()
+
+def remoteDevices(path):
+    """Gets the devices from the daemon, like a thin client started."""
+    import daemon
+    remote = daemon.RemoteStatus(path)
+    try:
+        return remote.getDevices()
+    finally:
+        remote.close()
+
+def checkLocalDevices(devices):
+    """
+    Compares the devices of a daemon with the local devices their actions
+    run on (see daemon.RemoteDevice.local()). Raises MyError on mismatch.
+    """
+    for dev in devices:
+        blocks = [dev.blk()]
+        for blk in blocks:
+            blocks.extend(blk.partitions() + blk.holders())
+        for remoteDev in [dev] + blocks:
+            local = remoteDev.local().snapshot()
+            if local.sysfs != remoteDev.sysfs():
+                raise backend.MyError("Local device differs: "+local.sysfs)
+        if dev.local().snapshot() != dev.snapshot():
+            raise backend.MyError("Local state differs: "+dev.sysfs())
+
+def benchDaemon():
+    """
+    Times a thin client getting the devices from a daemon serving the
+    current root, see daemon.py. Returns the seconds.
+    """
+    import daemon
+    tmpDir = tempfile.mkdtemp(prefix = "dfmon-daemon-")
+    server = daemon.Daemon(os.path.join(tmpDir, "socket"))
+    thread = threading.Thread(target = server.run)
+    thread.start()
+    try:
+        duration = timeIt(remoteDevices, os.path.join(tmpDir, "socket"))
+        # the actions run on the local devices, round trip
+        checkLocalDevices(remoteDevices(os.path.join(tmpDir, "socket")))
+        return duration
+    finally:
+        server.stop()
+        thread.join()
+        server.close()
+        shutil.rmtree(tmpDir)
+
+def benchBackend(counts = (10, 100, 1000), partitions = 2, holders = 10):
+    """
+    Times the backend on generated system trees with the given numbers of
+    disks, each has two partitions and the first ones a device-mapper
+    device on top (see makeFixture()). Returns the results of
+    benchStatus().
+    """
+    results = []
+    for count in counts:
+        root = tempfile.mkdtemp(prefix = "dfmon-fixture-")
+        try:
+            makeFixture(root, count, partitions, min(holders, count))
+            backend.setRoot(root)
+            results.extend(benchStatus())
+        finally:
+            backend.setRoot()
+            shutil.rmtree(root)
+    return results
+
+def benchCapture(filename):
+    """
+    Times the backend on a capture of a host, see capture.py. Returns the
+    results of benchStatus(), named after the capture.
+    """
+    import capture
+    try:
+        capture.replay(filename)
+        return benchStatus(os.path.basename(filename)+": ")
+    finally:
+        backend.setRoot()
+
+def startupTime(code, runs = 3):
+    """
+    Runs python code importing dfmon in a new interpreter, the best of a
+    few runs. Returns the duration in seconds and if Qt was imported.
+    """
+    code = ("import sys, dfmon; {0}; sys.exit('PyQt4' in sys.modules)"
+            .format(code))
+    topDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    devnull = open(os.devnull, "w")
+    best, qtLoaded = None, False
+    for dummy in range(0, runs):
+        start = time.time()
+        status = subprocess.call([sys.executable, "-c", code], cwd = topDir,
+                                 stdout = devnull, stderr = devnull)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+        qtLoaded = qtLoaded or status != 0
+    devnull.close()
+    return best, qtLoaded
+
+def benchStartup():
+    """
+    Times the startup without scanning the system, see STARTUP_BUDGETS.
+    Returns a list of result tuples: (name, seconds, budget, Qt imported)
+    """
+    results = []
+    for name, code, budget in STARTUP_BUDGETS:
+        seconds, qtLoaded = startupTime(code)
+        results.append((name, seconds, budget, qtLoaded))
+    return results
+
+def legacyOutput(cmdList):
+    """Runs a command like SysCmd.output() did before the CommandPump."""
+    cmd = subprocess.Popen(cmdList, stdout = subprocess.PIPE,
+                           stderr = subprocess.PIPE, stdin = subprocess.PIPE)
+    stderr = []
+    while cmd.poll() is None:
+        err = cmd.stderr.read(len(backend.PLAIN_SUDO_QUESTION)).strip()
+        stderr.append(err + cmd.stderr.readline())
+        time.sleep(0.1)
+    stderr.extend(cmd.stderr.readlines())
+    return cmd.stdout.readlines()
+
+def newOutput(cmdList):
+    return backend.SysCmd(cmdList).output()
+
+def runBatch(count, cmdList):
+    """Runs the commands at once, reading their output together."""
+    pump = backend.CommandPump()
+    cmds = [backend.SysCmd(cmdList) for dummy in range(0, count)]
+    for cmd in cmds:
+        pump.add(cmd)
+    pump.run()
+    return [cmd.output() for cmd in cmds]
+
+def benchCommands(count = 100, cmdList = ("echo", "dfmon")):
+    """
+    Times running a short command the given number of times: one after
+    another as before and with SysCmd, and all at once with a CommandPump.
+    Returns a list of result tuples: (name, commands, seconds)
+    """
+    cmdList = list(cmdList)
+    return [("commands legacy", count,
+             timeIt(lambda: [legacyOutput(cmdList)
+                             for dummy in range(0, count)])),
+            ("commands SysCmd", count,
+             timeIt(lambda: [newOutput(cmdList)
+                             for dummy in range(0, count)])),
+            ("commands CommandPump", count, timeIt(runBatch, count, cmdList))]
+
+def benchHelper(count = 100):
+    """
+    Times privileged operations by the helper process, started without
+    privileges (fake), compared to running a command for each of them.
+    Returns a list of result tuples: (name, operations, seconds)
+    """
+    privHelper = backend.PrivilegedHelper(fake = True)
+    try:
+        return [("helper calls", count,
+                 timeIt(lambda: [privHelper.call("umount", os.sep)
+                                 for dummy in range(0, count)])),
+                ("helper commands", count,
+                 timeIt(lambda: [newOutput(["true"])
+                                 for dummy in range(0, count)]))]
+    finally:
+        privHelper.close()
+
+def loadBaseline(filename):
+    """Returns the seconds by name and disks of a stored baseline."""
+    baseline = dict()
+    if not os.path.isfile(filename):
+        return baseline
+    for line in open(filename).read().splitlines():
+        seconds, count, name = line.split(None, 2)
+        baseline[(name, int(count))] = float(seconds)
+    return baseline
+
+def saveBaseline(filename, results):
+    lines = ["%.6f %d %s\n" % (seconds, count, name)
+             for name, count, seconds in results]
+    writeFile(filename, "".join(lines))
+
+def isRegression(seconds, baseline):
+    return (baseline is not None and seconds > baseline*REGRESSION_FACTOR
+            and seconds - baseline > REGRESSION_MIN)
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, dummy = getopt.getopt(argv[1:], "sb:n:r:")
+    except getopt.error, msg:
+        print >> sys.stderr, msg
+        print >> sys.stderr, __doc__
+        return 2
+    opts = dict(opts)
+    baselineFile = opts.get("-b", BASELINE_FILE)
+    counts = [int(n) for n in opts.get("-n", "10,100,1000").split(",")]
+    regressions = 0
+    print "startup: %28s %10s %12s" % ("", "time[ms]", "budget[ms]")
+    for name, seconds, budget, qtLoaded in benchStartup():
+        line = "%-36s %10.2f %12.2f" % (name, seconds*1e3, budget*1e3)
+        if seconds > budget or qtLoaded:
+            line += qtLoaded and " QT IMPORTED" or " OVER BUDGET"
+            regressions += 1
+        print line
+    checkUevents()
+    print "device memory: devices objects[B] snapshots[B]"
+    print "%22d %10d %12d" % benchDeviceMemory()
+    results = benchBackend(counts)
+    results.extend(benchCommands())
+    results.extend(benchHelper())
+    if "-r" in opts:
+        results.extend(benchCapture(opts["-r"]))
+    if guiAvailable():
+        for count, changes, update, rebuild in benchTreeRefresh():
+            name = "tree refresh {0} changes".format(changes)
+            results.append((name+" update", count, update))
+            results.append((name+" rebuild", count, rebuild))
+    else:
+        print "tree build and refresh: skipped, PyQt4 not available"
+    baseline = loadBaseline(baselineFile)
+    print "%-36s %6s %10s %12s" % ("", "disks", "time[ms]", "baseline[ms]")
+    for name, count, seconds in results:
+        reference = baseline.get((name, count), None)
+        line = "%-36s %6d %10.2f" % (name, count, seconds*1e3)
+        if reference is not None:
+            line += " %12.2f" % (reference*1e3)
+        if isRegression(seconds, reference):
+            line += " REGRESSION"
+            regressions += 1
+        print line
+    if "-s" in opts:
+        saveBaseline(baselineFile, results)
+        print "baseline stored:", baselineFile
+    elif regressions > 0:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# vim: set ts=4 sw=4 tw=0:
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# capture.py
+#
+# Copyright (c) 2010-2011, Ingo Breßler <dfmon@ingobressler.net>
+#
+# This file is part of dfmon.
+#
+# dfmon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dfmon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dfmon.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Capture of the system state read by the backend, for offline replay.
+
+A capture is a tar archive of the sysfs attributes, device files, udev
+database entries and mount and swap tables the backend reads. Device
+files are stored as empty files, their numbers in the device node table
+(see backend.setRoot()). Replaying extracts it and redirects the backend
+to it.
+"""
+
+import os
+import stat
+import time
+import atexit
+import shutil
+import tarfile
+import tempfile
+import StringIO
+import backend
+from backend import (MyError, getBlkDevPath, getSubDevicePaths,
+                     blockDeviceNumber, rootPath)
+
+class Capture(object):
+    """Collects the entries of a capture archive, by path."""
+    _entries = None # TarInfo objects and file contents by archive name
+    _devNodes = None # lines of the device node table
+
+    def __init__(self):
+        self._entries = dict()
+        self._devNodes = []
+
+    def name(self, path):
+        """Returns the archive name of a path below the root."""
+        return os.path.relpath(path, backend.ROOT_PATH)
+
+    def addData(self, path, data, mtime = None):
+        """Adds a file with the given content at the given path."""
+        info = tarfile.TarInfo(self.name(path))
+        info.size = len(data)
+        info.mtime = mtime or time.time()
+        self._entries[info.name] = (info, data)
+
+    def addPath(self, path):
+        """
+        Adds a file or directory (without its content) below the root,
+        including the symbolic links on its way and their targets.
+        """
+        current = backend.ROOT_PATH
+        for part in self.name(path).split(os.sep):
+            current = os.path.join(current, part)
+            if self.name(current) in self._entries:
+                if os.path.islink(current):
+                    current = os.path.realpath(current)
+                continue
+            statinfo = os.lstat(current)
+            info = tarfile.TarInfo(self.name(current))
+            info.mtime = statinfo.st_mtime
+            info.mode = stat.S_IMODE(statinfo.st_mode)
+            data = None
+            if stat.S_ISLNK(statinfo.st_mode):
+                info.type = tarfile.SYMTYPE
+                info.linkname = os.readlink(current)
+                if os.path.isabs(info.linkname): # keep it below the root
+                    info.linkname = os.path.relpath(
+                                        rootPath(info.linkname),
+                                        os.path.dirname(current))
+                self._entries[info.name] = (info, data)
+                current = os.path.realpath(current)
+                self.addPath(current)
+                continue
+            elif stat.S_ISDIR(statinfo.st_mode):
+                info.type = tarfile.DIRTYPE
+            elif blockDeviceNumber(current) is not None:
+                devNum = blockDeviceNumber(current)
+                data = ""
+                self._devNodes.append("{0}:{1} {2}\n".format(
+                                          os.major(devNum), os.minor(devNum),
+                                          os.sep + info.name))
+            elif stat.S_ISREG(statinfo.st_mode):
+                try:
+                    data = backend.readProcFile(current)
+                except MyError:
+                    continue # not readable, the backend can't either
+            else:
+                continue # other device files are not read
+            if data is not None:
+                info.size = len(data)
+            self._entries[info.name] = (info, data)
+
+    def addExisting(self, path):
+        """Adds a path if it exists, see addPath()."""
+        if os.path.lexists(path):
+            self.addPath(path)
+
+    def addBlockDevice(self, sysfsPath, devName):
+        """Adds the sysfs entries of a block device and its sub-devices."""
+        sysfsPath = os.path.realpath(sysfsPath)
+        for name in "dev", "size", "uevent", "device":
+            self.addExisting(os.path.join(sysfsPath, name))
+        self.addExisting(os.path.join(sysfsPath, "holders"))
+        devNum = backend.getDevNum(sysfsPath)
+        if devNum > 0:
+            devId = "{0}:{1}".format(os.major(devNum), os.minor(devNum))
+            self.addExisting(os.path.join(backend.OS_SYS_DEV_BLOCK_PATH,
+                                          devId))
+            self.addExisting(os.path.join(backend.OS_UDEV_DATA_PATH,
+                                          "b"+devId))
+        basePath = sysfsPath + os.sep
+        for path, name in (getSubDevicePaths(basePath, devName+"*") +
+                           getSubDevicePaths(basePath+"holders"+os.sep, "*")):
+            self.addPath(path)
+            self.addBlockDevice(path, name)
+
+    def addScsiDevices(self):
+        """Adds the sysfs entries of all scsi devices and their disks."""
+        self.addPath(backend.OS_SYS_PATH)
+        for entry in os.listdir(backend.OS_SYS_PATH):
+            devPath = os.path.join(backend.OS_SYS_PATH, entry, "device")
+            self.addExisting(devPath)
+            devPath = os.path.realpath(devPath)
+            for name in "type", "vendor", "model":
+                self.addExisting(os.path.join(devPath, name))
+            blkPath, devName = getBlkDevPath(devPath)
+            if not blkPath or not devName:
+                continue
+            self.addPath(blkPath)
+            self.addBlockDevice(blkPath, devName)
+            # the driver, see ScsiDevice.driver()
+            path = os.path.realpath(os.path.join(blkPath, "device"))
+            for dummy in range(0, 3):
+                path = os.path.dirname(path)
+            self.addExisting(os.path.join(path, "driver"))
+
+    def addDeviceFiles(self):
+        """Adds all block device files and links to them in /dev/."""
+        for root, dirs, files in os.walk(backend.OS_DEV_PATH):
+            for i in reversed(range(0, len(dirs))):
+                if dirs[i][0] == "." or dirs[i] == "input":
+                    del dirs[i]
+            for fn in files:
+                path = os.path.join(root, fn)
+                try:
+                    if blockDeviceNumber(path) is not None:
+                        self.addPath(path)
+                except OSError:
+                    continue
+
+    def write(self, filename):
+        self.addData(os.path.join(backend.ROOT_PATH, backend.DEV_NODES_FILE),
+                     "".join(self._devNodes))
+        archive = tarfile.open(filename, "w:gz")
+        try:
+            for name in sorted(self._entries.keys()):
+                info, data = self._entries[name]
+                if data is None:
+                    archive.addfile(info)
+                else:
+                    archive.addfile(info, StringIO.StringIO(data))
+        finally:
+            archive.close()
+
+def capture(filename):
+    """
+    Writes the system state read by the backend to a tar archive,
+    a replayed one as well.
+    """
+    cap = Capture()
+    try:
+        cap.addScsiDevices()
+        cap.addDeviceFiles()
+    except OSError, e:
+        raise MyError("Failed to capture the system state: "+str(e))
+    cap.addData(backend.OS_MOUNTINFO_PATH,
+                backend.readProcFile(backend.OS_MOUNTINFO_PATH))
+    cap.addData(backend.OS_SWAPS_PATH,
+                backend.readProcFile(backend.OS_SWAPS_PATH))
+    try:
+        cap.write(filename)
+    except (IOError, OSError, tarfile.TarError), e:
+        raise MyError("Failed to write '{0}': {1}".format(filename, str(e)))
+
+# symbolic links followed at most resolving a path, like the kernel
+MAX_LINKS = 40
+
+def resolveName(name, links):
+    """
+    Returns the path a relative path refers to after extraction, following
+    the symbolic links of the archive (targets by name) like the kernel.
+    None if it leaves the directory it starts in.
+    """
+    if os.path.isabs(name):
+        return None
+    parts = [] # resolved so far
+    pending = name.split(os.sep)
+    count = 0
+    while pending:
+        part = pending.pop(0)
+        if part in ("", "."):
+            continue
+        if part == "..":
+            if not parts:
+                return None
+            parts.pop()
+            continue
+        path = os.sep.join(parts + [part])
+        if path not in links:
+            parts.append(part)
+            continue
+        count += 1
+        target = links[path]
+        if count > MAX_LINKS or os.path.isabs(target):
+            return None
+        pending[:0] = target.split(os.sep) # relative to parts
+    return os.sep.join(parts)
+
+def extract(filename, root):
+    """
+    Extracts a capture, refuses entries written or pointing outside of
+    root, also by way of symbolic links extracted before.
+    """
+    try:
+        archive = tarfile.open(filename)
+        try:
+            members = archive.getmembers()
+            links = dict()
+            names = set()
+            for info in members:
+                if not (info.isreg() or info.isdir() or info.issym()):
+                    raise MyError("Unsupported capture entry: "+info.name)
+                name = os.path.normpath(info.name)
+                if name in names:
+                    raise MyError("Duplicate capture entry: "+info.name)
+                names.add(name)
+                if info.issym():
+                    links[name] = info.linkname
+            for info in members:
+                name = os.path.normpath(info.name)
+                if info.issym():
+                    valid = (resolveName(os.path.dirname(name), links)
+                             is not None and
+                             resolveName(os.path.join(os.path.dirname(name),
+                                                      info.linkname),
+                                         links) is not None)
+                else:
+                    valid = resolveName(name, links) is not None
+                if not valid:
+                    raise MyError("Invalid capture entry: "+info.name)
+            archive.extractall(root, members)
+        finally:
+            archive.close()
+    except (IOError, OSError, tarfile.TarError), e:
+        raise MyError("Failed to read '{0}': {1}".format(filename, str(e)))
+
+def replay(filename):
+    """
+    Redirects the backend to the extracted capture, it is removed on exit.
+    Returns the directory it was extracted to.
+    """
+    root = tempfile.mkdtemp(prefix = "dfmon-replay-")
+    atexit.register(shutil.rmtree, root, True)
+    extract(filename, root)
+    backend.setRoot(root)
+    return root
+
+# vim: set ts=4 sw=4 tw=0:
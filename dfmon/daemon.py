@@ -0,0 +1,647 @@
+# -*- coding: utf-8 -*-
+# daemon.py
+#
+# Copyright (c) 2010-2011, Ingo Breßler <dfmon@ingobressler.net>
+#
+# This file is part of dfmon.
+#
+# dfmon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dfmon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dfmon.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Headless dfmon daemon and its thin client.
+
+The daemon owns the system Status, rescans it on kernel notifications
+only and serves the device snapshots (see backend.ScsiSnapshot) to local
+clients over a Unix socket. Requests and messages are JSON lists, one
+per line:
+
+    ["snapshot"]    answered by ["snapshot", generation, [snapshots..]]
+    ["subscribe"]   the same, followed by a message for every change:
+                    ["delta", generation, [changed snapshots..],
+                     [sysfs paths removed..], [sysfs paths in order..]]
+    ["metrics"]     answered by ["metrics", text], the metrics of the
+                    daemon in Prometheus text format
+
+Snapshots are the JSON lists of the named tuples. RemoteStatus provides
+them to the user interfaces like the local Status, actions on the devices
+run locally.
+
+The socket is kept in a directory only root (or the user running the
+daemon) can write to, clients accept a daemon of root or their own user
+only.
+"""
+
+import os
+import sys
+import stat
+import time
+import json
+import struct
+import errno
+import select
+import signal
+import socket
+import logging
+import threading
+import backend
+from backend import MyError
+
+DAEMON_SOCKET_PATH = "/run/dfmon/dfmon.socket"
+DAEMON_CHECK_INTERVAL = 0.5 # in seconds, polling without notifications
+DAEMON_SETTLE_DELAY = 0.1 # in seconds, coalesces bursts of changes
+DAEMON_MAX_PENDING = 32*1024*1024 # bytes not sent, slower clients dropped
+DAEMON_MAX_REQUEST = 4096 # bytes of a request, longer ones drop the client
+DAEMON_RECV_SIZE = 65536
+# credentials of the peer of a Unix socket, see <asm/socket.h>
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+# strings are passed byte by byte, sysfs content is not always utf-8
+WIRE_ENCODING = "latin-1"
+
+def encodeMessage(msg):
+    return json.dumps(msg, encoding = WIRE_ENCODING, separators = (",", ":"))
+
+def toStr(value):
+    """Returns the strings of decoded JSON data as they were sent."""
+    if isinstance(value, unicode):
+        return value.encode(WIRE_ENCODING)
+    if isinstance(value, list):
+        return [toStr(item) for item in value]
+    return value
+
+def decodeBlock(data):
+    """Returns the BlockSnapshot of its JSON list."""
+    snapshot = backend.BlockSnapshot(*data)
+    return snapshot._replace(
+        ioFiles = tuple(snapshot.ioFiles),
+        mountPoints = tuple(snapshot.mountPoints),
+        partitions = tuple([decodeBlock(d) for d in snapshot.partitions]),
+        holders = tuple([decodeBlock(d) for d in snapshot.holders]))
+
+def decodeScsi(data):
+    """Returns the ScsiSnapshot of its JSON list."""
+    snapshot = backend.ScsiSnapshot(*data)
+    if snapshot.blk is not None:
+        snapshot = snapshot._replace(blk = decodeBlock(snapshot.blk))
+    return snapshot
+
+def checkSocketDir(path):
+    """
+    Raises MyError unless the directory of the socket belongs to root or
+    the current user and nobody else can write to it, i.e. put a socket
+    of a different daemon there.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    try:
+        dirStat = os.stat(dirname)
+    except OSError, e:
+        raise MyError("Failed to check the socket directory: "+str(e))
+    if (dirStat.st_uid not in (0, os.getuid()) or
+        dirStat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise MyError("The socket directory is writable by others: "+
+                      dirname)
+
+def peerUid(sock):
+    """Returns the user id of the process connected to a Unix socket."""
+    creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                            struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1] # pid, uid, gid
+
+class Daemon(object):
+    """Serves the device snapshots to the clients connected."""
+    _path = None
+    _status = None # the system Status served
+    _listener = None
+    _poller = None
+    _clients = None # sockets by file descriptor
+    _buffers = None # incomplete requests by file descriptor
+    _pending = None # output not sent yet by file descriptor
+    _subscribers = None # file descriptors of the subscribed clients
+    _changes = None # ChangeMonitor, polling if not monitored
+    _stopPipe = None # (read, write) file descriptors, see stop()
+    _snapshots = None # by sysfs path
+    _order = None # sysfs paths of the devices in order
+    _generation = None # number of changes so far
+    _rescanAt = None # time of the next scan, None if nothing changed
+
+    def __init__(self, path = DAEMON_SOCKET_PATH):
+        """Listens on the given socket path, raises MyError on failure."""
+        self._path = path
+        self._status = backend.status()
+        self._poller = select.poll()
+        self._clients = dict()
+        self._buffers = dict()
+        self._pending = dict()
+        self._subscribers = set()
+        self._snapshots = dict()
+        self._order = []
+        self._generation = 0
+        self._listener = self.listen(path)
+        self._poller.register(self._listener.fileno(), select.POLLIN)
+        self._stopPipe = os.pipe()
+        self._poller.register(self._stopPipe[0], select.POLLIN)
+        self._changes = backend.ChangeMonitor()
+        for fd, mask in self._changes.events().items():
+            self._poller.register(fd, mask)
+        self.rescan()
+
+    def listen(self, path):
+        """
+        Binds the socket, replaces a stale one of a previous daemon.
+        Creates its directory, which must not be writable by others.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            dirname = os.path.dirname(os.path.abspath(path))
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname, 0755)
+            checkSocketDir(path)
+            if os.path.exists(path):
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(path)
+                except socket.error:
+                    os.unlink(path) # nobody listening
+                else:
+                    raise MyError("A daemon is running already: "+path)
+                finally:
+                    probe.close()
+            sock.bind(path)
+            os.chmod(path, 0666) # read-only service for every local user
+            sock.listen(5)
+        except (socket.error, OSError, MyError), e:
+            sock.close()
+            raise MyError("Failed to listen on '{0}': {1}"
+                          .format(path, str(e)))
+        return sock
+
+    def generation(self):
+        return self._generation
+
+    def monitored(self):
+        """Tells if all changes are signaled, no polling needed."""
+        return self._changes.monitored()
+
+    def rescan(self):
+        """
+        Updates the snapshots, notifies the subscribers if anything
+        changed.
+        """
+        self._rescanAt = None
+        try:
+            snapshots = self._status.snapshot()
+        except (MyError, EnvironmentError), e:
+            logging.warning("Scan failed: "+str(e))
+            return
+        order = [snapshot.sysfs for snapshot in snapshots]
+        changed = [snapshot for snapshot in snapshots
+                   if self._snapshots.get(snapshot.sysfs) != snapshot]
+        removed = [key for key in self._snapshots if key not in order]
+        if not changed and not removed and order == self._order:
+            return
+        self._snapshots = dict(zip(order, snapshots))
+        self._order = order
+        self._generation += 1
+        msg = encodeMessage(["delta", self._generation, changed, removed,
+                             order])+"\n"
+        for fd in list(self._subscribers):
+            self.send(fd, msg)
+
+    def currentSnapshot(self):
+        return encodeMessage(["snapshot", self._generation,
+                              [self._snapshots[key]
+                               for key in self._order]])+"\n"
+
+    def accept(self):
+        try:
+            conn, dummy = self._listener.accept()
+        except socket.error:
+            return
+        conn.setblocking(False) # a stalled client must not block the others
+        self._clients[conn.fileno()] = conn
+        self._buffers[conn.fileno()] = ""
+        self._pending[conn.fileno()] = ""
+        self._poller.register(conn.fileno(), select.POLLIN)
+
+    def drop(self, fd):
+        self._poller.unregister(fd)
+        self._clients.pop(fd).close()
+        del self._buffers[fd]
+        del self._pending[fd]
+        self._subscribers.discard(fd)
+
+    def send(self, fd, msg):
+        """
+        Queues a message, sends as much as the socket takes without
+        blocking. The rest is sent when the client is ready, see flush().
+        """
+        self._pending[fd] += msg
+        if len(self._pending[fd]) > DAEMON_MAX_PENDING:
+            logging.info("Client dropped: too many messages pending")
+            self.drop(fd)
+            return
+        self.flush(fd)
+
+    def flush(self, fd):
+        try:
+            sent = self._clients[fd].send(self._pending[fd])
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                logging.info("Client dropped: "+str(e))
+                self.drop(fd)
+                return
+            sent = 0
+        self._pending[fd] = self._pending[fd][sent:]
+        mask = select.POLLIN
+        if self._pending[fd]:
+            mask |= select.POLLOUT
+        self._poller.modify(fd, mask)
+
+    def receive(self, fd):
+        """Handles the requests of a client."""
+        try:
+            data = self._clients[fd].recv(DAEMON_RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ""
+        if not data:
+            self.drop(fd)
+            return
+        if "\n" not in data: # searches the new data only
+            self._buffers[fd] += data
+            lines = []
+        else:
+            lines = (self._buffers[fd] + data).split("\n")
+            self._buffers[fd] = lines.pop()
+        if (len(self._buffers[fd]) > DAEMON_MAX_REQUEST or
+            [line for line in lines if len(line) > DAEMON_MAX_REQUEST]):
+            logging.info("Client dropped: request too long")
+            self.drop(fd)
+            return
+        for line in lines:
+            try:
+                request = toStr(json.loads(line))[0]
+            except (ValueError, TypeError, IndexError, KeyError):
+                request = None
+            if request == "snapshot":
+                self.send(fd, self.currentSnapshot())
+            elif request == "subscribe":
+                self._subscribers.add(fd)
+                self.send(fd, self.currentSnapshot())
+            elif request == "metrics":
+                self.send(fd, encodeMessage(["metrics",
+                                backend.metrics().prometheus()])+"\n")
+            else:
+                self.send(fd, encodeMessage(["error",
+                                "Invalid request: "+line[:80]])+"\n")
+            if fd not in self._clients:
+                return
+
+    def changed(self):
+        """Schedules a scan, changes often come in bursts."""
+        if self._rescanAt is None:
+            self._rescanAt = time.time() + DAEMON_SETTLE_DELAY
+
+    def stop(self):
+        """Makes run() return, may be called from another thread."""
+        os.write(self._stopPipe[1], "x")
+
+    def run(self):
+        """Serves the clients until stop() is called."""
+        nextCheck = time.time() + DAEMON_CHECK_INTERVAL
+        changeEvents = self._changes.events()
+        while True:
+            timeouts = []
+            if self._rescanAt is not None:
+                timeouts.append(self._rescanAt)
+            if not self.monitored():
+                timeouts.append(nextCheck)
+            timeout = -1 # forever
+            if timeouts:
+                timeout = max(0, int((min(timeouts) - time.time())*1000) + 1)
+            try:
+                events = self._poller.poll(timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for fd, event in events:
+                if fd == self._stopPipe[0]:
+                    return
+                elif fd == self._listener.fileno():
+                    self.accept()
+                elif fd in changeEvents:
+                    if self._changes.handle(fd):
+                        self.changed()
+                elif fd in self._clients:
+                    if event & select.POLLOUT:
+                        self.flush(fd)
+                    if fd in self._clients and event & ~select.POLLOUT:
+                        self.receive(fd)
+            if not self.monitored() and time.time() >= nextCheck:
+                nextCheck = time.time() + DAEMON_CHECK_INTERVAL
+                if (self._status.devStatusChanged() or
+                    self._status.mountStatusChanged()):
+                    self.changed()
+            if self._rescanAt is not None and time.time() >= self._rescanAt:
+                self.rescan()
+
+    def close(self):
+        for fd in list(self._clients):
+            self.drop(fd)
+        self._changes.close()
+        self._listener.close()
+        for fd in self._stopPipe:
+            os.close(fd)
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+def runDaemon(path = DAEMON_SOCKET_PATH):
+    """Runs the daemon until it is terminated. Returns the exit code."""
+    try:
+        daemon = Daemon(path)
+    except MyError, e:
+        print >> sys.stderr, str(e)
+        return 1
+    # terminate cleanly, the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+    return 0
+
+class RemoteDevice(object):
+    """A device shown from a snapshot of the daemon."""
+    _snapshot = None
+    _local = None # the device of the local system, for actions
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def snapshot(self):
+        return self._snapshot
+
+    def sysfs(self):
+        return self._snapshot.sysfs
+
+    def inUse(self):
+        return self._snapshot.inUse
+
+    def timeStamp(self):
+        return self._snapshot.timeStamp
+
+    def isBlock(self):
+        return False
+
+    def isScsi(self):
+        return False
+
+    def local(self):
+        """
+        Returns the device of the local system, for actions. Raises
+        MyError if it is not the device served.
+        """
+        if self._local is None:
+            dev = self.localDevice()
+            if dev.sysfs().rstrip(os.sep) != self.sysfs().rstrip(os.sep):
+                raise MyError("The local device differs from the one "
+                              "served: "+dev.sysfs())
+            self._local = dev
+        return self._local
+
+class RemoteBlockDevice(RemoteDevice):
+    _partitions = None
+    _holders = None
+
+    def isBlock(self):
+        return True
+
+    def localDevice(self):
+        return backend.BlockDevice(self.sysfs(), self._snapshot.devName)
+
+    def shortName(self):
+        return os.path.basename(self.fullName())
+
+    def fullName(self):
+        if not self._snapshot.ioFiles:
+            return ""
+        return self._snapshot.ioFiles[0]
+
+    def ioFiles(self):
+        return list(self._snapshot.ioFiles)
+
+    def mountPoints(self):
+        return list(self._snapshot.mountPoints)
+
+    def mountPoint(self):
+        if not self._snapshot.mountPoints:
+            return ""
+        return self._snapshot.mountPoints[0]
+
+    def size(self):
+        return self._snapshot.size
+
+    def partitions(self):
+        if self._partitions is None:
+            self._partitions = [RemoteBlockDevice(snapshot) for snapshot
+                                in self._snapshot.partitions]
+        return self._partitions
+
+    def holders(self):
+        if self._holders is None:
+            self._holders = [RemoteBlockDevice(snapshot) for snapshot
+                             in self._snapshot.holders]
+        return self._holders
+
+    def mount(self, password = None):
+        return self.local().mount(password)
+
+    def umount(self):
+        return self.local().umount()
+
+    def flush(self):
+        return self.local().flush()
+
+class RemoteScsiDevice(RemoteDevice):
+    _blk = None
+
+    def isScsi(self):
+        return True
+
+    def localDevice(self):
+        # named after the scsi address in sysfs, scsiStr is for display
+        return backend.ScsiDevice(backend.OS_SYS_PATH,
+                                  os.path.basename(self.sysfs()))
+
+    def shortName(self):
+        return self.scsiStr()
+
+    def fullName(self):
+        return self.scsiStr()+" "+self.model()
+
+    def scsiStr(self):
+        return self._snapshot.scsiStr
+
+    def model(self):
+        return self._snapshot.model
+
+    def vendor(self):
+        return self._snapshot.vendor
+
+    def driver(self):
+        return self._snapshot.driver
+
+    def blk(self):
+        if self._blk is None and self._snapshot.blk is not None:
+            self._blk = RemoteBlockDevice(self._snapshot.blk)
+        return self._blk
+
+    def mount(self):
+        return self.local().mount()
+
+    def umount(self):
+        return self.local().umount()
+
+    def flush(self):
+        return self.local().flush()
+
+    def remove(self, *args):
+        return self.local().remove(*args)
+
+class RemoteStatus(backend.Status):
+    """
+    Status of the devices as served by the daemon, the local system
+    status is used for the actions only. Provides a file descriptor for
+    select()/poll() or Qt socket notifiers, readable on changes.
+    """
+    _sock = None
+    _buffer = None # incomplete message received
+    _lock = None # the GUI reads changes and devices in different threads
+    _devices = None # RemoteScsiDevices by sysfs path
+    _order = None # sysfs paths of the devices in order
+    _generation = None # of the daemon, None before the first snapshot
+    _changed = None # True if changes were received but not reported
+
+    def __init__(self, path = DAEMON_SOCKET_PATH):
+        """Subscribes to the daemon, raises MyError on failure."""
+        # changes are reported by the daemon, nothing to monitor here
+        backend.Status.__init__(self, monitor = False)
+        self._buffer = ""
+        self._lock = threading.RLock()
+        self._devices = dict()
+        self._order = []
+        self._changed = False
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            checkSocketDir(path)
+            self._sock.connect(path)
+            if peerUid(self._sock) not in (0, os.getuid()):
+                raise MyError("The daemon runs as a different user")
+            self._sock.sendall(encodeMessage(["subscribe"])+"\n")
+        except (socket.error, MyError), e:
+            self._sock.close()
+            self._sock = None
+            raise MyError("Failed to connect to the daemon at '{0}': {1}"
+                          .format(path, str(e)))
+        while self._generation is None:
+            self.receive(True)
+
+    def isRemote(self):
+        return True
+
+    def isConnected(self):
+        return self._sock is not None
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+        finally:
+            self._lock.release()
+
+    def receive(self, block = False):
+        """Applies the messages received, waits for one if block is set."""
+        self._lock.acquire()
+        try:
+            if self._sock is None:
+                raise MyError("The connection to the daemon was closed")
+            while block or select.select([self._sock], [], [], 0)[0]:
+                block = False
+                try:
+                    data = self._sock.recv(DAEMON_RECV_SIZE)
+                except socket.error, e:
+                    data = ""
+                if not data:
+                    self._sock.close()
+                    self._sock = None
+                    self._changed = True # the error is reported by a scan
+                    return
+                lines = (self._buffer + data).split("\n")
+                self._buffer = lines.pop()
+                for line in lines:
+                    self.apply(toStr(json.loads(line)))
+        finally:
+            self._lock.release()
+
+    def apply(self, msg):
+        if msg[0] == "snapshot":
+            snapshots = [decodeScsi(data) for data in msg[2]]
+            self._devices = dict([(s.sysfs, RemoteScsiDevice(s))
+                                  for s in snapshots])
+            self._order = [snapshot.sysfs for snapshot in snapshots]
+        elif msg[0] == "delta":
+            for data in msg[2]:
+                snapshot = decodeScsi(data)
+                self._devices[snapshot.sysfs] = RemoteScsiDevice(snapshot)
+            for key in msg[3]:
+                self._devices.pop(key, None)
+            self._order = msg[4]
+        elif msg[0] == "error":
+            logging.warning("Daemon: "+str(msg[1]))
+            return
+        self._generation = msg[1]
+        self._changed = True
+
+    def changed(self):
+        """Tells if the devices changed since the last call."""
+        self._lock.acquire()
+        try:
+            if self._sock is not None:
+                self.receive()
+            changed = self._changed
+            self._changed = False
+            return changed
+        finally:
+            self._lock.release()
+
+    def devStatusChanged(self):
+        return self.changed()
+
+    def getDevices(self):
+        self._lock.acquire()
+        try:
+            self.receive()
+            self._changed = False
+            return [self._devices[key] for key in self._order]
+        finally:
+            self._lock.release()
+
+# vim: set ts=4 sw=4 tw=0:
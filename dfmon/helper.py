@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# helper.py
+#
+# Copyright (c) 2010-2011, Ingo Breßler <dfmon@ingobressler.net>
+#
+# This file is part of dfmon.
+#
+# dfmon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dfmon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dfmon.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Privileged helper process of dfmon.
+
+Started once per session by the sudo handler (see backend.helper()),
+it connects to the Unix socket given and runs the operations requested
+until the socket is closed. Only a fixed set of operations is accepted,
+their arguments are checked before anything is done:
+
+    umount <mount point>            umount(2)
+    flush <block device file>       BLKFLSBUF ioctl, like 'blockdev'
+    delete <sysfs delete file>      writes '1' to it
+    truecrypt <arguments>           runs truecrypt (mount or dismount)
+
+Requests and responses are JSON lists, one per line:
+[id, operation, arguments..] and [id, error message or null, output].
+Requests are handled concurrently, responses may arrive in any order.
+
+Usage:
+    $ python dfmon/helper.py [--fake] <socket>
+    --fake  checks the requests but does nothing, no privileges needed
+
+This file does not import the rest of dfmon, it runs as root.
+"""
+
+import sys
+import os
+import re
+import stat
+import json
+import fcntl
+import socket
+import threading
+import subprocess
+import ctypes
+import ctypes.util
+
+# ioctl flushing the buffers of a block device, see <linux/fs.h>
+BLKFLSBUF = 0x1261
+
+SYSFS_DEVICES_PATH = "/sys/devices/"
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+# truecrypt options accepted, with the number of values they take
+TRUECRYPT_OPTIONS = {"-t": 0, "--non-interactive": 0, "-p": 1,
+                     "--mount": 1, "-d": 1}
+
+class HelperError(StandardError):
+    pass
+
+def unescape(path):
+    """Decodes octal escapes in mount table fields, e.g. '\\040' (space)"""
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), path)
+
+def mountPoints():
+    fd = open(MOUNTINFO_PATH)
+    try:
+        return [unescape(line.split()[4]) for line in fd if line.strip()]
+    finally:
+        fd.close()
+
+def checkPath(path):
+    if not isinstance(path, basestring) or not os.path.isabs(path):
+        raise HelperError("Not an absolute path: "+repr(path))
+    return os.path.normpath(path)
+
+def checkUmount(mountPoint):
+    mountPoint = checkPath(mountPoint)
+    if mountPoint not in mountPoints():
+        raise HelperError("Not a mount point: "+mountPoint)
+    return mountPoint
+
+def checkFlush(devFile):
+    devFile = checkPath(devFile)
+    try:
+        if not stat.S_ISBLK(os.stat(devFile).st_mode):
+            raise HelperError("Not a block device: "+devFile)
+    except OSError, e:
+        raise HelperError(str(e))
+    return devFile
+
+def checkDelete(delPath):
+    delPath = os.path.realpath(checkPath(delPath))
+    if (not delPath.startswith(SYSFS_DEVICES_PATH) or
+        os.path.basename(delPath) != "delete" or not os.path.isfile(delPath)):
+        raise HelperError("Not a device delete file: "+delPath)
+    return delPath
+
+def checkTruecrypt(*args):
+    i = 0
+    while i < len(args):
+        count = TRUECRYPT_OPTIONS.get(args[i])
+        if count is None or i+count >= len(args):
+            raise HelperError("Invalid truecrypt arguments")
+        i += count+1
+    if "--mount" not in args and "-d" not in args:
+        raise HelperError("Invalid truecrypt arguments")
+    return args
+
+def umount(mountPoint):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.umount(mountPoint) != 0:
+        err = ctypes.get_errno()
+        raise HelperError("umount: {0}: {1}"
+                          .format(mountPoint, os.strerror(err)))
+    return ""
+
+def flush(devFile):
+    fd = os.open(devFile, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKFLSBUF, 0)
+    finally:
+        os.close(fd)
+    return ""
+
+def delete(delPath):
+    fd = open(delPath, "w")
+    try:
+        fd.write("1")
+    finally:
+        fd.close()
+    return ""
+
+def truecrypt(*args):
+    cmd = subprocess.Popen(["truecrypt"] + list(args),
+                           stdin = open(os.devnull),
+                           stdout = subprocess.PIPE,
+                           stderr = subprocess.PIPE)
+    stdout, stderr = cmd.communicate()
+    if cmd.returncode != 0:
+        raise HelperError("truecrypt: {0}\n{1}"
+                          .format(cmd.returncode, stderr))
+    return stdout
+
+# the operations by name: argument check and implementation
+OPERATIONS = {"umount": (checkUmount, umount),
+              "flush": (checkFlush, flush),
+              "delete": (checkDelete, delete),
+              "truecrypt": (checkTruecrypt, truecrypt)}
+
+class Helper(object):
+    """Runs the requests read from a socket, each in its own thread."""
+    _sock = None
+    _lock = None # for writing responses
+    _fake = None
+
+    def __init__(self, sock, fake = False):
+        self._sock = sock
+        self._lock = threading.Lock()
+        self._fake = fake
+
+    def run(self):
+        reader = self._sock.makefile("r")
+        for line in iter(reader.readline, ""):
+            try:
+                request = json.loads(line)
+                int(request[0])
+            except (ValueError, TypeError, IndexError, KeyError):
+                continue # no one to respond to
+            thread = threading.Thread(target = self.handle, args = request)
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, reqId, op = None, *args):
+        error, output = None, ""
+        try:
+            if op not in OPERATIONS:
+                raise HelperError("Unknown operation: "+repr(op))
+            check, fct = OPERATIONS[op]
+            for arg in args:
+                if not isinstance(arg, basestring):
+                    raise HelperError("Invalid argument: "+repr(arg))
+            args = check(*[arg.encode("utf-8") for arg in args])
+            if not isinstance(args, tuple):
+                args = (args, )
+            if not self._fake:
+                output = fct(*args)
+        except TypeError:
+            error = "Invalid arguments for "+op
+        except (HelperError, EnvironmentError), e:
+            error = str(e)
+        response = json.dumps([reqId, error, output])+"\n"
+        self._lock.acquire()
+        try:
+            self._sock.sendall(response)
+        except socket.error:
+            pass # the client is gone
+        finally:
+            self._lock.release()
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv
+    args = argv[1:]
+    fake = "--fake" in args
+    if fake:
+        args.remove("--fake")
+    if len(args) != 1:
+        print >> sys.stderr, __doc__
+        return 2
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args[0])
+    except socket.error, e:
+        print >> sys.stderr, "Failed to connect to '{0}': {1}".format(
+                                args[0], str(e))
+        return 1
+    # nothing is read from or written to the sudo handler anymore
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(0, 3):
+        os.dup2(devnull, fd)
+    Helper(sock, fake).run()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# vim: set ts=4 sw=4 tw=0:
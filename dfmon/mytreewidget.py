@@ -26,13 +26,16 @@ But also data access (Scsi- and BlockDevice) and action processing is
 implemented here.
 """
 
+import os
 import time
+import logging
 from PyQt4.QtCore import (QObject, QCoreApplication, SIGNAL, QThread, Qt,
-                          QVariant, QTimer, QString)
+                          QVariant, QTimer, QString, QSocketNotifier)
 from PyQt4.QtGui import (QAction, QTreeWidgetItem, QTreeWidget, QLineEdit,
-                         QInputDialog, QMenu, QMessageBox)
+                         QInputDialog, QMenu, QMessageBox,
+                         QAbstractItemView)
 import backend
-from backend import formatSize, formatTimeDistance
+from backend import formatSize, formatTimeDistance, traced
 import traceback
 
 def tr(s): # translation shortcut
@@ -52,14 +55,21 @@ class MyAction(QAction):
                                             self.text(), self.methodObj)
 
 class IoThread(QThread):
-    """Runs device actions (system commands) in the background"""
+    """
+    Runs device actions (system commands) and system scans in the
+    background
+    """
 
     def __init__(self, parent = None):
         QThread.__init__(self, parent)
 
     def run(self):
         self.actionHandler = ActionHandler()
-        backend.STATUS.sudoPwdFct = self.actionHandler.emitPwdSignal
+        self.scanner = Scanner()
+        try:
+            backend.status().sudoPwdFct = self.actionHandler.emitPwdSignal
+        except backend.MyError:
+            pass # the scanner reports it
         self.exec_()
 
 class ActionHandler(QObject):
@@ -81,26 +91,144 @@ class ActionHandler(QObject):
         QObject.emit(self, SIGNAL("passwordDialog(PyQt_PyObject)"), resList)
         return str(resList[0])
 
+class Scanner(QObject):
+    """
+    Scans the system for devices and checks for changes. All access to
+    the system status happens here, the GUI gets the finished device list.
+    """
+    def scan(self):
+        try:
+            devices = deviceEntries(backend.status().getDevices())
+        except Exception, e:
+            QObject.emit(self, SIGNAL("exception(QString, PyQt_PyObject)"),
+                         tr("refresh"), e)
+            devices = None
+        QObject.emit(self, SIGNAL("scanDone(PyQt_PyObject)"), devices)
+
+    def checkChanges(self, devices = True, mounts = True):
+        """Polls for device and/or mount changes (fallback)."""
+        if (devices and backend.status().devStatusChanged()) or \
+           (mounts and backend.status().mountStatusChanged()):
+            QObject.emit(self, SIGNAL("changed(void)"))
+
+def collectDevices(dev, devices):
+    """Adds the device and its sub-devices to the dict, by sysfs path."""
+    devices[dev.sysfs()] = dev
+    if dev.isScsi():
+        if dev.blk():
+            collectDevices(dev.blk(), devices)
+        return
+    for sub in dev.partitions() + dev.holders():
+        collectDevices(sub, devices)
+
+def deviceEntries(devices):
+    """
+    Returns a (device, snapshot, sub-devices by sysfs path) tuple for each
+    device. Reads everything the GUI shows, in the calling (io) thread,
+    the items show the snapshot only and keep the devices for the actions.
+    """
+    entries = []
+    for dev in devices:
+        subDevices = dict()
+        snapshot = dev.snapshot()
+        collectDevices(dev, subDevices)
+        entries.append((dev, snapshot, subDevices))
+    return entries
+
+def deviceKey(snapshot):
+    """Identifies the item of a device across refreshes."""
+    return snapshot.sysfs
+
+def shortName(snapshot):
+    """Returns the short device name of a snapshot for GUI display."""
+    if isinstance(snapshot, backend.ScsiSnapshot):
+        return snapshot.scsiStr
+    return os.path.basename(fullName(snapshot))
+
+def fullName(snapshot):
+    """Returns the complete device name of a snapshot."""
+    if isinstance(snapshot, backend.ScsiSnapshot):
+        return snapshot.scsiStr+" "+snapshot.model
+    if not snapshot.ioFiles:
+        return ""
+    return snapshot.ioFiles[0]
+
+def syncItems(parent, entries):
+    """
+    Makes the children of the given item show the given device entries
+    (see deviceEntries()), in order. Items are matched to devices by key
+    and patched in place, missing ones are inserted and obsolete ones
+    removed. Returns the number of items changed.
+    """
+    keys = set([deviceKey(snapshot) for dev, snapshot, sub in entries])
+    items = dict()
+    changes = 0
+    for i in reversed(range(0, parent.childCount())):
+        item = parent.child(i)
+        key = deviceKey(item.snapshot())
+        if key in keys and key not in items:
+            items[key] = item
+        else: # obsolete
+            parent.takeChild(i)
+            changes += 1 + item.overallChildCount()
+    for i, entry in enumerate(entries):
+        item = items.get(deviceKey(entry[1]), None)
+        if item is None:
+            item = MyTreeWidgetItem(entry)
+            parent.insertChild(i, item)
+            item.expandAll()
+            changes += 1 + item.overallChildCount()
+            continue
+        if parent.indexOfChild(item) != i:
+            # taking an item drops the expansion state of its subtree
+            states = [(it, it.isExpanded()) for it in item.subtree()]
+            parent.takeChild(parent.indexOfChild(item))
+            parent.insertChild(i, item)
+            for it, expanded in states:
+                it.setExpanded(expanded)
+            changes += 1
+        changes += item.setDev(entry)
+    return changes
+
 class MyTreeWidgetItem(QTreeWidgetItem):
     """An item (row) in the GUI device tree. Has an associated device and 
     keeps track of the existing and visible children of a node."""
-    _dev = None # one element list (&reference ?)
+    _dev = None # the device, for actions
+    _snapshot = None # its immutable state shown
+    _subDevices = None # sub-devices by sysfs path, for the child items
     _overallChildCount = None
     _visibleChildCount = None
 
     def dev(self):
-        return self._dev[0]
+        return self._dev
+
+    def snapshot(self):
+        return self._snapshot
 
     # setup methods
 
-    def __init__(self, dev):
+    def __init__(self, entry):
         QTreeWidgetItem.__init__(self, None)
-        #self._dev = dev # this produces cascaded instance duplication somehow
-        # don't want to copy the complete Device incl. sublists
-        self._dev = [dev]
+        self._dev, self._snapshot, self._subDevices = entry
         self._overallChildCount = 0
         self._visibleChildCount = 0
         self.configure()
+        self.updateChildren()
+
+    def setDev(self, entry):
+        """
+        Shows the device entry of a newer scan (see deviceEntries()),
+        updates the changed parts only. Devices changed in place by an
+        action are the same object with a new snapshot, so the snapshots
+        are compared. Returns the number of items changed.
+        """
+        snapshot = self._snapshot
+        self._dev, self._snapshot, self._subDevices = entry
+        changes = self.updateChildren() # new devices for the actions
+        if self._snapshot == snapshot:
+            return changes # same state
+        self.configure()
+        return 1 + changes
 
     def expanded(self):
         self._visibleChildCount = self.childCount()
@@ -114,42 +242,61 @@ class MyTreeWidgetItem(QTreeWidgetItem):
         if self.parent():
             self.parent().expanded()
 
-    def addBlockDevice(self, dev):
-        if not dev:
-            return
-        item = MyTreeWidgetItem(dev)
-        for part in dev.partitions():
-            item.addBlockDevice(part)
-        for holder in dev.holders():
-            item.addBlockDevice(holder)
-        self.addChild(item)
-        self._overallChildCount += 1 + item.overallChildCount()
+    def childEntries(self):
+        """Returns the device entries shown as children of this item."""
+        snapshot = self.snapshot()
+        if isinstance(snapshot, backend.ScsiSnapshot):
+            if snapshot.blk is None:
+                return []
+            snapshots = [snapshot.blk]
+        else:
+            snapshots = list(snapshot.partitions + snapshot.holders)
+        return [(self._subDevices[sub.sysfs], sub, self._subDevices)
+                for sub in snapshots]
+
+    def updateChildren(self):
+        """Updates the child items, returns the number of items changed."""
+        changes = syncItems(self, self.childEntries())
+        self._overallChildCount = 0
+        for i in range(0, self.childCount()):
+            self._overallChildCount += 1 + self.child(i).overallChildCount()
+        if changes > 0 and self.isExpanded():
+            self.expanded() # update the visible child count
+        return changes
+
+    def subtree(self):
+        """Returns this item and all its children, recursively."""
+        items = [self]
+        for i in range(0, self.childCount()):
+            items.extend(self.child(i).subtree())
+        return items
 
     def configure(self):
         if not self.dev():
             return
-        self.setText(0, self.dev().shortName())
+        snapshot = self.snapshot()
+        self.setText(0, shortName(snapshot))
         # decide usage status
         toolTip = tr("[not used]")
-        if self.dev().inUse():
+        if snapshot.inUse:
             toolTip = tr("[in use]")
         statusTip = ""+toolTip
         # generate extended device type dependent info
-        toolTip += " " + self.dev().fullName()
-        if self.dev().isBlock():
-            if self.dev().inUse():
-                mp = self.dev().mountPoint()
+        toolTip += " " + fullName(snapshot)
+        if isinstance(snapshot, backend.BlockSnapshot):
+            if snapshot.inUse:
+                mp = ", ".join(snapshot.mountPoints)
                 if len(mp): 
                     toolTip += tr(" [mountpoint: %1]").arg(mp)
                 else:
                     toolTip += tr(" [not mounted]")
-            sizeStr = tr(" size: %1").arg(formatSize(self.dev().size()))
+            sizeStr = tr(" size: %1").arg(formatSize(snapshot.size))
             toolTip += sizeStr
             statusTip += sizeStr
-        elif self.dev().isScsi():
-            statusTip += " " + self.dev().model()
+        elif isinstance(snapshot, backend.ScsiSnapshot):
+            statusTip += " " + snapshot.model
             curtime = int(time.time())
-            ts = self.dev().timeStamp()
+            ts = snapshot.timeStamp
             dist = curtime - ts
             if dist > 0:
                 toolTip += tr(" (added %1 ago)").arg(formatTimeDistance(dist))
@@ -157,9 +304,7 @@ class MyTreeWidgetItem(QTreeWidgetItem):
         self.setToolTip(0, toolTip)
         self.setStatusTip(0, statusTip)
         self.setData(0, Qt.UserRole,
-                     QVariant(self.dev().inUse())) # for the delegate
-        if self.dev().isScsi():
-            self.addBlockDevice(self.dev().blk())
+                     QVariant(snapshot.inUse)) # for the delegate
 
     def overallChildCount(self):
         """Returns the recursive child count."""
@@ -179,11 +324,24 @@ class MyTreeWidget(QTreeWidget):
     _visibleRowCount = None # overall count of rows
     _ioThread = None
     _checkInterval = 500 # in milliseconds
+    _scanner = None # Scanner of the ioThread, once connected
+    _scanning = None # True while the scanner is busy
+    _rescan = None # True if a refresh was requested while scanning
+    _scanStarted = None # time of the scan request, for metrics
+    _monitor = None # backend.UeventMonitor, polling if not available
+    _notifier = None
+    _mountWatcher = None # backend.ProcFileWatcher of the mount table
+    _mountNotifier = None
 
     def __init__(self, parent=None):
         QTreeWidget.__init__(self, parent)
         self._ioThread = IoThread(self)
         self._timer = QTimer()
+        # delays the refresh after a change was detected, coalesces bursts
+        self._refreshTimer = QTimer(self)
+        self._refreshTimer.setSingleShot(True)
+        QObject.connect(self._refreshTimer, SIGNAL("timeout(void)"),
+                        self.refreshAction)
         # connect some signals/slots
         QObject.connect(self,
                         SIGNAL("customContextMenuRequested(const QPoint&)"),
@@ -197,7 +355,10 @@ class MyTreeWidget(QTreeWidget):
         QObject.connect(self._ioThread,
                         SIGNAL("started(void)"),
                         self.connectIoThread)
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self._visibleRowCount = 0
+        self._scanning = False
+        self._rescan = False
         self._ioThread.start()
 
     def cleanup(self):
@@ -218,6 +379,61 @@ class MyTreeWidget(QTreeWidget):
             QObject.connect(self._ioThread.actionHandler,
                             SIGNAL("passwordDialog(PyQt_PyObject)"),
                             self.passwordDialog, Qt.BlockingQueuedConnection)
+            scanner = self._ioThread.scanner
+            self._scanner = scanner
+            QObject.connect(self, SIGNAL("scanRequested(void)"),
+                            scanner.scan, Qt.QueuedConnection)
+            QObject.connect(self, SIGNAL("checkRequested(bool, bool)"),
+                            scanner.checkChanges, Qt.QueuedConnection)
+            QObject.connect(scanner, SIGNAL("scanDone(PyQt_PyObject)"),
+                            self.scanDone, Qt.QueuedConnection)
+            QObject.connect(scanner,
+                            SIGNAL("exception(QString, PyQt_PyObject)"),
+                            self.exceptionHandler, Qt.QueuedConnection)
+            QObject.connect(scanner, SIGNAL("changed(void)"),
+                            self.scheduleRefresh, Qt.QueuedConnection)
+            self.setupChangeDetection()
+            self.refreshAction() # initial scan
+
+    def setupChangeDetection(self):
+        """
+        Listens for kernel uevents and mount table changes,
+        polls the system status as fallback. A daemon signals all changes.
+        """
+        try:
+            remote = backend.status().isRemote()
+        except backend.MyError:
+            remote = False
+        if remote:
+            self._notifier = QSocketNotifier(backend.status().fileno(),
+                                             QSocketNotifier.Read, self)
+            QObject.connect(self._notifier, SIGNAL("activated(int)"),
+                            self.daemonChanged)
+            return
+        try:
+            self._monitor = backend.UeventMonitor()
+        except backend.MyError, e:
+            logging.info(str(e)+", polling for device changes")
+            self._monitor = None
+        else:
+            self._notifier = QSocketNotifier(self._monitor.fileno(),
+                                             QSocketNotifier.Read, self)
+            QObject.connect(self._notifier, SIGNAL("activated(int)"),
+                            self.ueventReceived)
+        try:
+            self._mountWatcher = backend.ProcFileWatcher(
+                                        backend.OS_MOUNTINFO_PATH)
+        except backend.MyError, e:
+            logging.info(str(e)+", polling for mount changes")
+            self._mountWatcher = None
+        else:
+            # POLLPRI is reported as exception by select()
+            self._mountNotifier = QSocketNotifier(
+                                        self._mountWatcher.fileno(),
+                                        QSocketNotifier.Exception, self)
+            QObject.connect(self._mountNotifier, SIGNAL("activated(int)"),
+                            self.mountTableChanged)
+        if self._monitor is None or self._mountWatcher is None:
             QObject.connect(self._timer, SIGNAL("timeout(void)"),
                             self.refreshActionIfNeeded)
             self._timer.start(self._checkInterval)
@@ -265,7 +481,21 @@ class MyTreeWidget(QTreeWidget):
         if item is None:
             return
         menu = QMenu(self)
-        if item.dev().isScsi():
+        devices = [selected.dev() for selected in self.selectedItems()
+                   if selected.dev().isScsi()]
+        if len(devices) > 1 and item.isSelected():
+            def removeAll():
+                raise backend.MultiRemovalInfo(backend.removeDevices(devices))
+            removeAllAction = MyAction(removeAll,
+                    tr("umount all && remove {0} devices"
+                       .format(len(devices))), menu)
+            if self._ioThread.isRunning():
+                QObject.connect(removeAllAction,
+                                SIGNAL("triggered(QString, PyQt_PyObject)"),
+                                self._ioThread.actionHandler.doAction,
+                                Qt.QueuedConnection)
+            menu.addAction(removeAllAction)
+        elif item.dev().isScsi():
             removeAction = MyAction(item.dev().remove,
                                     tr("umount all && remove"), menu)
             if self._ioThread.isRunning():
@@ -274,7 +504,7 @@ class MyTreeWidget(QTreeWidget):
                                 self._ioThread.actionHandler.doAction,
                                 Qt.QueuedConnection)
             menu.addAction(removeAction)
-        if item.dev().inUse():
+        if item.snapshot().inUse:
             umountAction = MyAction(item.dev().umount, tr("umount"), menu)
             if self._ioThread.isRunning():
                 QObject.connect(umountAction,
@@ -324,6 +554,16 @@ class MyTreeWidget(QTreeWidget):
             QMessageBox.information(self, tr("Success"), 
                     tr("It is safe to unplug the device now."),
                     QMessageBox.Ok, QMessageBox.Ok)
+        except backend.MultiRemovalInfo, e:
+            if e.failed():
+                QMessageBox.warning(self, tr("Removal Failed"),
+                        failureText+str(e),
+                        QMessageBox.Ok, QMessageBox.Ok)
+            else:
+                QMessageBox.information(self, tr("Success"),
+                        str(e)+"\n"+
+                        tr("It is safe to unplug the devices now."),
+                        QMessageBox.Ok, QMessageBox.Ok)
         except Exception, e:
             QMessageBox.critical(self, tr("An Error Occurred: {0}"
                                           .format(type(e).__name__)),
@@ -331,40 +571,75 @@ class MyTreeWidget(QTreeWidget):
                                 str(e), 
                                 QMessageBox.Ok, QMessageBox.Ok)
 
+    def ueventReceived(self, fd):
+        if self._monitor.changed():
+            self.scheduleRefresh()
+
+    def daemonChanged(self, fd):
+        remote = backend.status()
+        if remote.changed():
+            self.scheduleRefresh()
+        if not remote.isConnected():
+            self._notifier.setEnabled(False) # the scan reports the error
+
+    def mountTableChanged(self, fd):
+        # the event notifier already consumed the change indication
+        self.scheduleRefresh()
+
     def refreshActionIfNeeded(self, checked = False):
-        if backend.STATUS.devStatusChanged() \
-        or backend.STATUS.mountStatusChanged():
-            # wait a moment after change detected 
-            # (let the system create device files, etc..)
-            # sometimes, an exception occurs here (for 500ms delay):
-            # "Could not find IO device path" BlockDevice.__init__()
-            QTimer.singleShot(int(2*self._checkInterval), self.refreshAction)
+        # changes are signaled by uevents and mount table polling, if possible
+        QObject.emit(self, SIGNAL("checkRequested(bool, bool)"),
+                     self._monitor is None, self._mountWatcher is None)
 
-    def refreshAction(self, checked = False):
-        """Updates items as needed"""
-# add recursive __eq__/__ne__ to Scsi/BlockDevice
-# get status, compare new devices with those in the tree
-# if name is the same, remove and add new one at same position
-# otherwise remove obsolete items, add new ones on top
-# (ignore time -> bus reset)
-#        print "refreshAction"
-#        rootItem = self.invisibleRootItem()
-#        for i in range(0, rootItem.childCount()):
-#            print rootItem.child(i).text(0)
-        self.clear()
+    def scheduleRefresh(self):
+        # wait a moment after change detected 
+        # (let the system create device files, etc..)
+        # sometimes, an exception occurs here (for 500ms delay):
+        # "Could not find IO device path" BlockDevice.__init__()
+        self._refreshTimer.start(int(2*self._checkInterval))
 
+    def refreshAction(self, checked = False):
+        """Requests a scan in the background, see scanDone()"""
+        if self._scanner is None:
+            return # scans initially when the ioThread is connected
+        if self._scanning:
+            self._rescan = True # system changed during the scan
+            return
+        self._scanning = True
+        self._scanStarted = time.time()
+        QObject.emit(self, SIGNAL("scanRequested(void)"))
+
+    def scanDone(self, devices):
+        """Updates the items of changed devices only"""
+        self._scanning = False
+        started = self._scanStarted
+        if self._rescan:
+            self._rescan = False
+            self.refreshAction()
+        if devices is not None:
+            changes = self.updateItems(devices)
+            backend.metrics().count("dfmon_gui_refreshes_total")
+            backend.metrics().count("dfmon_gui_items_changed_total", changes)
+            backend.metrics().observe("dfmon_gui_refresh_seconds",
+                                      time.time() - started)
+
+    @traced("MyTreeWidget.updateItems")
+    def updateItems(self, devices):
+        """
+        Updates the tree to show the given device entries (see
+        deviceEntries()), returns the number of items changed.
+        """
+        changes = syncItems(self.invisibleRootItem(), devices)
+        if changes > 0:
+            self.setVisibleRowCount()
+            QObject.emit(self, SIGNAL("contentChanged(void)"))
+        return changes
+
+    @traced("MyTreeWidget.reset")
     def reset(self):
-        """Deletes all items and rebuild the tree"""
+        """Resets the view and rebuilds the items as needed"""
         QTreeWidget.reset(self)
-        rootItem = self.invisibleRootItem()
-        try:
-            for dev in backend.STATUS.getDevices():
-#                print "dev:", dev.scsiStr()
-                item = MyTreeWidgetItem(dev)
-                rootItem.addChild(item)
-                item.expandAll()
-        except Exception, e:
-            self.exceptionHandler(tr("refresh"), e)
+        self.refreshAction()
         self.setVisibleRowCount()
         QObject.emit(self, SIGNAL("contentChanged(void)"))
 
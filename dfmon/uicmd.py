@@ -21,10 +21,18 @@
 """Commandline interface for dfmon (rudimentary).
 """
 
+import sys
 import time
+import errno
+import select
+from collections import OrderedDict
 import backend
 from backend import MyError, DeviceInUseWarning, removeLineBreak, formatSize
 
+# watching the devices, see watchStatus()
+WATCH_CHECK_INTERVAL = 1.0 # in seconds, polling without notifications
+WATCH_SETTLE_DELAY = 0.1 # in seconds, coalesces bursts of changes
+
 def inUseStr(isInUse):
     if isInUse:
         return "[used]"
@@ -40,11 +48,11 @@ def formatBlkDev(blkDev, lvl, prefix):
     for dummy in range(0, lvl):
         o = o + " "
     # add the description of a single device
-    o = o + prefix + blkDev.ioFile()
+    o = o + prefix + blkDev.fullName()
     line.append(o) # first column
     # add usage status
     line.append(inUseStr(blkDev.inUse()))
-    line.append(blkDev.mountPoint())
+    line.append(", ".join(blkDev.mountPoints()))
     line.append(formatSize(blkDev.size())) # last column
     res = []
     res.append(line) # output is list of lines (which are column lists)
@@ -83,7 +91,7 @@ def printBlkDev(blkDev):
     return printTable(formatBlkDev(blkDev, 1, "'> "))
 
 def getStatus():
-    devList = backend.STATUS.getDevices()
+    devList = backend.status().getDevices()
     i = 0
     for dev in devList:
         out = "("+str(i) + ")\t"
@@ -100,6 +108,147 @@ def getStatus():
 
     return devList
 
+def removeDevices(devList, numbers):
+    """Removes the devices with the given numbers concurrently."""
+    devices = [devList[int(n)] for n in numbers
+               if n.isdigit() and int(n) < len(devList)]
+    if not devices:
+        print "no valid device selected."
+        return
+    print "removing:", ", ".join([dev.scsiStr() for dev in devices])
+    for dev, e in backend.removeDevices(devices):
+        if e is None:
+            print dev.fullName()+": removed, safe to unplug"
+        else:
+            print dev.fullName()+": failed,", e
+
+def flattenBlock(blk, scsi, devices):
+    """
+    Adds a block device snapshot and its sub-devices to the dictionary,
+    by sysfs path as (snapshot, scsi snapshot or None for sub-devices).
+    """
+    devices[blk.sysfs] = (blk, scsi)
+    for dev in blk.partitions + blk.holders:
+        flattenBlock(dev, None, devices)
+    return devices
+
+def flattenStatus(snapshots):
+    """Returns the block devices of scsi snapshots in order, see above."""
+    devices = OrderedDict()
+    for scsi in snapshots:
+        flattenBlock(scsi.blk, scsi, devices)
+    return devices
+
+def describeBlock(blk, scsi = None):
+    text = blk.devName
+    if scsi is not None:
+        text += " "+" ".join([s for s in (scsi.scsiStr, scsi.vendor,
+                                            scsi.model) if s])
+    text += ", "+formatSize(blk.size)
+    if blk.mountPoints:
+        text += ", mounted on "+", ".join(blk.mountPoints)
+    return text
+
+def diffStatus(old, new):
+    """
+    Returns lines describing the block devices added, removed and
+    changed, by size or mount points, between two flattened states.
+    """
+    lines = []
+    for key, (blk, dummy) in old.items():
+        if key not in new:
+            lines.append("- "+blk.devName)
+    for key, (blk, scsi) in new.items():
+        if key not in old:
+            lines.append("+ "+describeBlock(blk, scsi))
+            continue
+        prev = old[key][0]
+        if prev is blk: # unchanged devices keep their snapshot
+            continue
+        for mountPoint in blk.mountPoints:
+            if mountPoint not in prev.mountPoints:
+                lines.append("* {0} mounted on {1}"
+                             .format(blk.devName, mountPoint))
+        for mountPoint in prev.mountPoints:
+            if mountPoint not in blk.mountPoints:
+                lines.append("* {0} unmounted from {1}"
+                             .format(blk.devName, mountPoint))
+        if prev.size != blk.size:
+            lines.append("* {0} resized to {1}"
+                         .format(blk.devName, formatSize(blk.size)))
+    return lines
+
+def printChanges(old, new):
+    """Prints the changes with a time stamp, returns the new state."""
+    stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    for line in diffStatus(old, new):
+        print stamp, line
+    sys.stdout.flush()
+    return new
+
+def watchStatus():
+    """
+    Prints the devices, then the changes of devices and mount states as
+    they happen until interrupted. Waits for kernel notifications (or
+    the daemon) between the scans, polls only if they are not available.
+    """
+    changes = None
+    try:
+        statusObj = backend.status()
+        poller = select.poll()
+        if statusObj.isRemote():
+            poller.register(statusObj.fileno(), select.POLLIN)
+            monitored = True
+        else:
+            changes = backend.ChangeMonitor()
+            for fd, mask in changes.events().items():
+                poller.register(fd, mask)
+            monitored = changes.monitored()
+        devices = printChanges(dict(), flattenStatus(statusObj.snapshot()))
+        nextCheck = time.time() + WATCH_CHECK_INTERVAL
+        rescanAt = None
+        while True:
+            timeouts = []
+            if rescanAt is not None:
+                timeouts.append(rescanAt)
+            if not monitored:
+                timeouts.append(nextCheck)
+            timeout = -1 # forever
+            if timeouts:
+                timeout = max(0, int((min(timeouts) - time.time())*1000) + 1)
+            try:
+                events = poller.poll(timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for fd, dummy in events:
+                if changes is None:
+                    changed = statusObj.changed()
+                    if not statusObj.isConnected():
+                        rescanAt = time.time() # reports the error
+                else:
+                    changed = changes.handle(fd)
+                if changed and rescanAt is None:
+                    rescanAt = time.time() + WATCH_SETTLE_DELAY
+            if not monitored and time.time() >= nextCheck:
+                nextCheck = time.time() + WATCH_CHECK_INTERVAL
+                if (statusObj.devStatusChanged() or
+                    statusObj.mountStatusChanged()):
+                    rescanAt = time.time()
+            if rescanAt is not None and time.time() >= rescanAt:
+                rescanAt = None
+                devices = printChanges(devices,
+                                       flattenStatus(statusObj.snapshot()))
+    except MyError, e:
+        print >> sys.stderr, "Watching the devices failed:", e
+        return 1
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        if changes is not None:
+            changes.close()
+
 def consoleMenu():
     try:
         devList = getStatus()
@@ -107,8 +256,11 @@ def consoleMenu():
         print "Error initializing system status: ", e
     else:
         intext = removeLineBreak(
-            raw_input("\n=> Select a device ('q' for quit): "))
-        if intext != "q" and intext.isdigit():
+            raw_input("\n=> Select a device ('r <n> <n> ..' for removal, "+
+                      "'q' for quit): "))
+        if intext.split()[:1] == ["r"]:
+            removeDevices(devList, intext.split()[1:])
+        elif intext != "q" and intext.isdigit():
             d = int(intext)
             if d < 0:
                 d = 0